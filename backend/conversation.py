@@ -0,0 +1,210 @@
+import json
+import os
+import re
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from shared_cache import SharedCache
+
+# Follow-ups that lean on earlier turns and need rewriting before retrieval
+FOLLOW_UP_PATTERNS = [
+    r"\b(it|its|it's|they|them|their|this|that|these|those|he|she|one|ones)\b",
+    r"^(and|also|but|so|what about|how about|why|more|same)\b",
+]
+
+CONDENSE_PROMPT = """Rewrite the user's latest message as a standalone search query about skiing, using the conversation for context. Reply with the query only.
+
+Conversation:
+{history}
+
+Latest message: {message}"""
+
+
+class ConversationManager:
+    """
+    Server-side chat sessions for the encyclopedia mode.
+
+    Each session keeps a compact state: recent turns trimmed to a token budget plus the last
+    retrieval (query, embedding and matched chunks). Follow-ups are condensed into standalone
+    retrieval queries, and when the condensed query stays close to the previous one the
+    cached chunks are reused instead of querying the index again. State lives in the
+    SharedCache so any worker can continue any session; saves are compare-and-set, so
+    messages answered concurrently for the same session all keep their turns.
+    """
+
+    def __init__(self, rag,
+                 history_token_budget: Optional[int] = None,
+                 reuse_threshold: Optional[float] = None,
+                 session_ttl: Optional[float] = None):
+        """
+        Args:
+            rag (EncyclopediaRAG): Engine used for retrieval and generation
+            history_token_budget (int): Approximate tokens of history sent to the model
+                (SESSION_HISTORY_TOKENS, default 1500)
+            reuse_threshold (float): Cosine similarity above which the previous retrieval
+                is reused (SESSION_REUSE_THRESHOLD, default 0.85)
+            session_ttl (float): Seconds an idle session is kept (SESSION_TTL, default 3600)
+        """
+        self.rag = rag
+        self.history_token_budget = history_token_budget or int(os.getenv("SESSION_HISTORY_TOKENS", "1500"))
+        self.reuse_threshold = reuse_threshold or float(os.getenv("SESSION_REUSE_THRESHOLD", "0.85"))
+        self.session_ttl = session_ttl or float(os.getenv("SESSION_TTL", "3600"))
+        self.store = SharedCache(namespace="session:")
+
+    def _load_raw(self, session_id: str) -> Tuple[Dict, Optional[bytes]]:
+        raw = self.store.get(session_id)
+        if raw is None:
+            return {"turns": [], "retrieval": None}, None
+        return json.loads(raw), raw
+
+    def load(self, session_id: str) -> Dict:
+        """Return the state of a session, or a fresh one."""
+        return self._load_raw(session_id)[0]
+
+    def save(self, session_id: str, state: Dict):
+        self.store.set(session_id, json.dumps(state).encode("utf-8"), ttl=self.session_ttl)
+
+    def _append_turns(self, session_id: str, state: Dict, raw: Optional[bytes],
+                      new_turns: List[Dict], attempts: int = 5):
+        """
+        Save a session with new turns appended, without losing turns saved concurrently.
+
+        `state` and `raw` are what this request loaded. If another request saved the session
+        in the meantime, the new turns are appended to its state instead and the save retried.
+        """
+        for _ in range(attempts):
+            state["turns"] = self.trim_history(state["turns"] + new_turns)
+            value = json.dumps(state).encode("utf-8")
+            if self.store.compare_and_set(session_id, raw, value, ttl=self.session_ttl):
+                return
+            retrieval = state["retrieval"]
+            state, raw = self._load_raw(session_id)
+            state["retrieval"] = retrieval
+        print(f"Could not save session {session_id} after {attempts} attempts")
+
+    @staticmethod
+    def _estimate_tokens(text: str) -> int:
+        # ~4 characters per token for English text
+        return len(text) // 4 + 1
+
+    def trim_history(self, turns: List[Dict]) -> List[Dict]:
+        """
+        Keep the most recent turns that fit in the token budget.
+
+        The newest turn is always kept; if it alone exceeds the budget its content is cut short.
+        """
+        kept = []
+        used = 0
+        for turn in reversed(turns):
+            cost = self._estimate_tokens(turn["content"])
+            if used + cost > self.history_token_budget:
+                if not kept:
+                    content = turn["content"][:self.history_token_budget * 4 - 4]
+                    kept.append({**turn, "content": content})
+                break
+            kept.append(turn)
+            used += cost
+        return list(reversed(kept))
+
+    @staticmethod
+    def is_follow_up(message: str) -> bool:
+        """Whether a message probably depends on earlier turns."""
+        normalized = message.strip().lower()
+        if len(normalized.split()) <= 3:
+            return True
+        return any(re.search(pattern, normalized) for pattern in FOLLOW_UP_PATTERNS)
+
+    def condense(self, state: Dict, message: str) -> str:
+        """Rewrite a follow-up into a standalone retrieval query."""
+        if not state["turns"] or not self.is_follow_up(message):
+            return message
+
+        history = "\n".join(f"{turn['role']}: {turn['content'][:500]}" for turn in state["turns"][-4:])
+        try:
+            response = self.rag.client.chat_completion(
+                model=self.rag.router.fast_model,
+                messages=[{"role": "user", "content": CONDENSE_PROMPT.format(history=history, message=message)}],
+                max_tokens=64,
+                timeout=10,
+            )
+            condensed = response.choices[0].message.content.strip()
+            if condensed:
+                return condensed
+        except Exception as e:
+            print(f"Could not condense follow-up, falling back to the previous query: {str(e)}")
+
+        previous = state["retrieval"]["query"] if state["retrieval"] else ""
+        return f"{previous} {message}".strip()
+
+    def retrieve(self, state: Dict, query: str, filters: Optional[Dict],
+                 prefetched: Optional[Dict] = None) -> List[Dict]:
+        """
+        Reuse the previous retrieval when the query stays on topic, else query the index.
+
+        prefetched can hold a {"embedding", "matches"} retrieval already done for this query
+        while it was being typed (see PrefetchManager).
+        """
+        if prefetched is not None:
+            embedding = np.asarray(prefetched["embedding"], dtype=np.float32)
+            matches = prefetched["matches"]
+            state["retrieval"] = {
+                "query": query,
+                "embedding": embedding.tolist(),
+                "matches": matches,
+                "filters": filters,
+            }
+            return matches
+
+        embedding = np.asarray(self.rag._embed_query(query), dtype=np.float32)
+        previous = state["retrieval"]
+        if previous and previous.get("filters") == filters:
+            previous_embedding = np.asarray(previous["embedding"], dtype=np.float32)
+            similarity = float(embedding @ previous_embedding /
+                               (np.linalg.norm(embedding) * np.linalg.norm(previous_embedding) + 1e-9))
+            if similarity >= self.reuse_threshold:
+                print(f"Reusing retrieval for on-topic follow-up (similarity={similarity:.3f})")
+                return previous["matches"]
+
+        matches = self.rag.retrieve_cached(query, filters=filters)
+        state["retrieval"] = {
+            "query": query,
+            "embedding": embedding.tolist(),
+            "matches": matches,
+            "filters": filters,
+        }
+        return matches
+
+    def respond(self, session_id: str, message: str, filters: Optional[Dict] = None,
+                prefetched: Optional[Dict] = None) -> str:
+        """
+        Answer a message in the context of a session.
+
+        Args:
+            session_id (str): Conversation ID from the client
+            message (str): Latest user message
+            filters (Dict): Optional retrieval filters
+            prefetched (Dict): Optional prefetched retrieval for the message, only used when
+                the message does not need rewriting into a standalone query
+
+        Returns:
+            str: Assistant response
+        """
+        state, raw = self._load_raw(session_id)
+        standalone = self.condense(state, message)
+        if standalone != message:
+            prefetched = None
+        matches = self.retrieve(state, standalone, filters, prefetched)
+
+        response = self.rag.generate_response(
+            message,
+            filters=filters,
+            history=self.trim_history(state["turns"]),
+            matches=matches,
+        )
+
+        self._append_turns(session_id, state, raw, [
+            {"role": "user", "content": message},
+            {"role": "assistant", "content": response},
+        ])
+        return response
@@ -1,20 +1,89 @@
 from pathlib import Path
-from typing import List
+from typing import List, Dict, Optional
 from pinecone import Pinecone, ServerlessSpec
-from openai import OpenAI
 from dotenv import load_dotenv
 import os
 from chromadb.utils import embedding_functions
 import time
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+from vector_index import QuantizedIVFIndex
+from facet_index import FacetIndex
+from index_snapshots import SnapshotManager, SnapshotWatcher, IndexVersionMarker
+from shared_cache import SharedCache
+from llm_client import get_llm_client
+from model_router import ModelRouter
+from query_log import QueryLog, normalize_query
+import json
 
 load_dotenv()
 
 class EncyclopediaRAG:
-    def __init__(self, data_dir: str = "data/texts"):
+    def __init__(self, data_dir: str = "data/texts", local_index_dir: str = None):
         self.data_dir = Path(data_dir)
         self.index_name = "ski-sage-summit"
         
-        # Initialize Pinecone
+        # Serve from a fixed local index if configured, else from the current versioned
+        # snapshot (hot-swapped when a new one is activated). Pinecone serves until a
+        # snapshot has loaded, including when none was activated yet or loading it failed
+        local_index_dir = local_index_dir or os.getenv("LOCAL_INDEX_DIR")
+        self.local_index = None
+        self.snapshot_watcher = None
+        if local_index_dir and (Path(local_index_dir) / QuantizedIVFIndex.MANIFEST).exists():
+            self.local_index = QuantizedIVFIndex(local_index_dir)
+            print(f"Using local {self.local_index.quantization} index with {self.local_index.count} vectors")
+        else:
+            self.snapshot_watcher = SnapshotWatcher(SnapshotManager("text"))
+            self.local_index = self.snapshot_watcher.index
+            if self.local_index is None:
+                self._initialize_pinecone()
+        # Written by the Pinecone ingest paths, so re-ingesting invalidates cached results
+        self.pinecone_version = IndexVersionMarker(self.index_name)
+        self.index_version = self._current_index_version()
+        
+        # Initialize ChromaDB embeddings with caching
+        self.embedding_function = embedding_functions.SentenceTransformerEmbeddingFunction(
+            model_name="all-MiniLM-L6-v2"
+        )
+        # Small per-process embedding cache in front of a cache shared by all workers
+        self.embedding_cache = OrderedDict()
+        self.embedding_cache_size = int(os.getenv("EMBEDDING_CACHE_SIZE", "1024"))
+        self.shared_cache = SharedCache(namespace="encyclopedia:")
+        
+        # Retrieval results and precomputed answers for standalone queries, keyed by
+        # normalized query and only valid for the index version they were built from
+        self.retrieval_cache = OrderedDict()
+        self.answer_cache = OrderedDict()
+        # The LRU caches are shared by the request threads and the cache-warming thread
+        self.cache_lock = threading.RLock()
+        self.response_cache_size = int(os.getenv("RESPONSE_CACHE_SIZE", "512"))
+        self.query_log = QueryLog()
+        
+        # Shared OpenAI client with pooling, timeouts and retries
+        self.client = get_llm_client()
+        # Use a faster model option
+        self.model = "chatgpt-4o-latest"
+        # Route simple, well-matched queries to a cheaper model (or an extractive answer)
+        self.router = ModelRouter.from_env(large_model=self.model)
+        self.use_router = os.getenv("ROUTER_ENABLED", "1") == "1"
+        
+        # Define system prompt
+        self.system_prompt = """You are an expert skiing instructor and guide. Use the following relevant information from skiing books and manuals to answer the user's question. Be specific and detailed in your response, citing techniques and concepts from the source material.
+
+Context information:
+{context}
+
+Remember to:
+1. Focus on practical, actionable advice
+2. Explain techniques clearly and systematically
+3. Include safety considerations when relevant
+4. Use proper skiing terminology
+"""
+
+    def _initialize_pinecone(self):
+        """Connect to the Pinecone index, creating it if needed"""
         if not os.getenv("PINECONE_API_KEY"):
             raise ValueError("PINECONE_API_KEY environment variable is not set")
             
@@ -35,68 +104,247 @@ class EncyclopediaRAG:
                 ) 
             )
         self.index = self.pc.Index(self.index_name)
+
+    def _current_index_version(self) -> str:
+        """Identifier of the index being served, used to invalidate cached results"""
+        if self.snapshot_watcher is not None and self.snapshot_watcher.version is not None:
+            return f"snapshot:{self.snapshot_watcher.version}"
+        if self.local_index is not None:
+            return f"local:{self.local_index.manifest.get('version', self.local_index.manifest['created_at'])}"
+        if os.getenv("INDEX_VERSION"):
+            return os.getenv("INDEX_VERSION")
+        return f"pinecone:{self.index_name}:{self.pinecone_version.version or 'unversioned'}"
+
+    def _refresh_index(self):
+        """Switch to a newly activated snapshot or re-ingested Pinecone index and drop results cached from the old one"""
+        if self.snapshot_watcher is not None and self.snapshot_watcher.refresh():
+            self.local_index = self.snapshot_watcher.index
+        elif self.local_index is not None or not self.pinecone_version.refresh():
+            return
+        self.index_version = self._current_index_version()
+        with self.cache_lock:
+            self.retrieval_cache.clear()
+            self.answer_cache.clear()
+
+    def _cache_put(self, cache: OrderedDict, key: str, value):
+        """Insert into a bounded LRU cache"""
+        with self.cache_lock:
+            cache[key] = value
+            cache.move_to_end(key)
+            while len(cache) > self.response_cache_size:
+                cache.popitem(last=False)
+
+    def _cache_get(self, cache: OrderedDict, key: str):
+        """Look up a bounded LRU cache, marking the entry as recently used; None on a miss"""
+        with self.cache_lock:
+            value = cache.get(key)
+            if value is not None:
+                cache.move_to_end(key)
+            return value
+
+    def warm_from(self, path: str) -> int:
+        """
+        Load precomputed embeddings, retrieval results and answers written by warm_cache.py.
         
-        # Initialize ChromaDB embeddings with caching
-        self.embedding_function = embedding_functions.SentenceTransformerEmbeddingFunction(
-            model_name="all-MiniLM-L6-v2"
-        )
-        self.embedding_cache = {}  # Add embedding cache
+        Entries built against a different index version are ignored.
         
-        # Initialize OpenAI client
-        self.client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-        # Use a faster model option
-        self.model = "chatgpt-4o-latest"
+        Returns:
+            int: Number of queries warmed
+        """
+        if not os.path.exists(path):
+            return 0
+        with open(path, "r", encoding="utf-8") as f:
+            warm = json.load(f)
+        if warm.get("index_version") != self.index_version:
+            print(f"Skipping cache warm file built for index {warm.get('index_version')}, "
+                  f"serving {self.index_version}")
+            return 0
         
-        # Define system prompt
-        self.system_prompt = """You are an expert skiing instructor and guide. Use the following relevant information from skiing books and manuals to answer the user's question. Be specific and detailed in your response, citing techniques and concepts from the source material.
+        for entry in warm["entries"]:
+            self._cache_embedding(entry["query"], entry["embedding"])
+            for key in entry["aliases"]:
+                self._cache_put(self.retrieval_cache, key, entry["matches"])
+                if entry.get("answer"):
+                    self._cache_put(self.answer_cache, key, entry["answer"])
+        print(f"Warmed caches with {len(warm['entries'])} frequent queries")
+        return len(warm["entries"])
 
-Context information:
-{context}
+    def reconnect(self):
+        """Re-open network handles after the process forks (see gunicorn.conf.py)"""
+        if self.local_index is None:
+            self.index = self.pc.Index(self.index_name)
 
-Remember to:
-1. Focus on practical, actionable advice
-2. Explain techniques clearly and systematically
-3. Include safety considerations when relevant
-4. Use proper skiing terminology
-"""
+    def _cache_embedding(self, query: str, query_embedding: List[float]):
+        """Store an embedding in the per-process LRU cache"""
+        with self.cache_lock:
+            self.embedding_cache[query] = query_embedding
+            self.embedding_cache.move_to_end(query)
+            while len(self.embedding_cache) > self.embedding_cache_size:
+                self.embedding_cache.popitem(last=False)
 
-    def retrieve_relevant_chunks(self, query: str, k: int = 5) -> List[str]:
-        """Retrieve relevant chunks for a query"""
-        # Check cache first
-        if query in self.embedding_cache:
-            query_embedding = self.embedding_cache[query]
+    def _embed_query(self, query: str) -> List[float]:
+        """Embed a query, using the embedding caches"""
+        # Check the process-local cache first
+        cached_embedding = self._cache_get(self.embedding_cache, query)
+        if cached_embedding is not None:
+            return cached_embedding
+        
+        # Then the cache shared with the other workers
+        cache_key = "emb:" + hashlib.sha1(query.encode("utf-8")).hexdigest()
+        cached = self.shared_cache.get(cache_key)
+        if cached is not None:
+            query_embedding = np.frombuffer(cached, dtype=np.float32).tolist()
         else:
             # Generate embeddings for the query
             query_embedding = self.embedding_function([query])[0].tolist()
-            # Cache the embedding
-            self.embedding_cache[query] = query_embedding
+            self.shared_cache.set(cache_key, np.asarray(query_embedding, dtype=np.float32).tobytes())
+        
+        # Cache the embedding
+        self._cache_embedding(query, query_embedding)
+        return query_embedding
+
+    @staticmethod
+    def _pinecone_filter(filters: Dict[str, List[str]]) -> Dict:
+        """
+        Translate {field: values} filters into a Pinecone metadata filter.
+        
+        Values match case-insensitively, like the local facet index, through the lowercase
+        <field>_key copies written at ingest; vectors ingested before those existed still
+        match on the exact value.
+        """
+        clauses = []
+        for field, values in filters.items():
+            values = values if isinstance(values, list) else [values]
+            clauses.append({"$or": [
+                {f"{field}_key": {"$in": FacetIndex.normalize(values)}},
+                {field: {"$in": values}},
+            ]})
+        return clauses[0] if len(clauses) == 1 else {"$and": clauses}
+
+    def retrieve_scored_chunks(self, query: str, k: int = 5,
+                               filters: Optional[Dict[str, List[str]]] = None) -> List[Dict]:
+        """
+        Retrieve relevant chunks with their ids, similarity scores and metadata.
+        
+        filters maps a metadata field (source, title, categories) to the accepted values;
+        values within a field are ORed and fields are ANDed.
+        """
+        self._refresh_index()
+        query_embedding = self._embed_query(query)
+        
+        if self.local_index is not None:
+            # Query the local quantized index, pre-filtered by its facet bitmaps
+            matches = []
+            search_results = self.local_index.search(
+                np.asarray(query_embedding, dtype=np.float32), k=k, filters=filters
+            )
+            for row, score in search_results:
+                record = self.local_index.record(row)
+                matches.append({
+                    "id": record["id"],
+                    "score": score,
+                    "text": record["metadata"]["text"],
+                    "metadata": record["metadata"]
+                })
+            return matches
         
         # Query Pinecone
         results = self.index.query(
             vector=query_embedding,
             top_k=k,
-            include_metadata=True
+            include_metadata=True,
+            filter=self._pinecone_filter(filters) if filters else None
         )
-        
+        return [
+            {
+                "id": match.id,
+                "score": match.score,
+                "text": match.metadata['text'],
+                "metadata": match.metadata
+            }
+            for match in results.matches
+        ]
+
+    def retrieve_cached(self, query: str, filters: Optional[Dict[str, List[str]]] = None) -> List[Dict]:
+        """
+        Retrieve scored chunks, serving unfiltered queries from the retrieval cache (which
+        warm_from fills with frequent queries).
+        """
+        if filters:
+            return self.retrieve_scored_chunks(query, filters=filters)
+        key = normalize_query(query)
+        matches = self._cache_get(self.retrieval_cache, key)
+        if matches is not None:
+            return matches
+        matches = self.retrieve_scored_chunks(query)
+        self._cache_put(self.retrieval_cache, key, matches)
+        return matches
+
+    def retrieve_relevant_chunks(self, query: str, k: int = 5,
+                                 filters: Optional[Dict[str, List[str]]] = None) -> List[str]:
+        """Retrieve relevant chunks for a query"""
         # Extract texts from results
-        texts = [match.metadata['text'] for match in results.matches]
-        return texts
+        return [match["text"] for match in self.retrieve_scored_chunks(query, k, filters)]
 
-    def generate_response(self, query: str, model_override: str = None) -> str:
-        """Generate a response using RAG"""
-        relevant_chunks = self.retrieve_relevant_chunks(query)
-        context = "\n\n".join(relevant_chunks)
+    def generate_response(self, query: str, model_override: str = None,
+                          filters: Optional[Dict[str, List[str]]] = None,
+                          history: Optional[List[Dict[str, str]]] = None,
+                          matches: Optional[List[Dict]] = None) -> str:
+        """
+        Generate a response using RAG.
+        
+        history holds earlier {"role", "content"} turns of the conversation, and matches
+        can supply already-retrieved chunks to skip the vector query.
+        """
+        start = time.time()
+        self._refresh_index()
+        # Only plain standalone queries can be served from the query-keyed caches, and a
+        # cached answer would ignore chunks the caller retrieved itself
+        cacheable = not (model_override or filters or history)
+        key = normalize_query(query)
+        
+        answer = self._cache_get(self.answer_cache, key) if cacheable and matches is None else None
+        if answer is not None:
+            with self.cache_lock:
+                cached_ids = [m["id"] for m in self.retrieval_cache.get(key, [])]
+            self.query_log.record(query, (time.time() - start) * 1000, cached_ids,
+                                  self.index_version, route="cached")
+            return answer
+        
+        if matches is None and cacheable:
+            matches = self.retrieve_cached(query)
+        elif matches is None:
+            matches = self.retrieve_scored_chunks(query, filters=filters)
+        
+        route = None
+        if model_override:
+            model_to_use = model_override
+        elif self.use_router:
+            decision = self.router.route(query, matches)
+            route = decision["route"]
+            if route == "extractive":
+                self.query_log.record(query, (time.time() - start) * 1000,
+                                      [m["id"] for m in matches], self.index_version, route=route)
+                return decision["answer"]
+            model_to_use = decision["model"]
+        else:
+            model_to_use = self.model
+        
+        context = "\n\n".join(match["text"] for match in matches)
         formatted_system_prompt = self.system_prompt.format(context=context)
-        model_to_use = model_override if model_override else self.model
         
-        response = self.client.chat.completions.create(
+        response = self.client.chat_completion(
             model=model_to_use,
             messages=[
                 {"role": "system", "content": formatted_system_prompt},
+                *(history or []),
                 {"role": "user", "content": query}
             ],
         )
-        return response.choices[0].message.content
+        answer = response.choices[0].message.content
+        self.query_log.record(query, (time.time() - start) * 1000,
+                              [m["id"] for m in matches], self.index_version, route=route)
+        return answer
     
 
 if __name__ == "__main__":
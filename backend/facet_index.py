@@ -0,0 +1,130 @@
+import json
+import numpy as np
+from pathlib import Path
+from typing import Dict, List, Optional, Union
+
+FilterValue = Union[str, List[str]]
+
+# Encyclopedia chunk metadata fields that retrieval can filter on (TextProcessor.FACET_FIELDS)
+TEXT_FACET_FIELDS = ["source", "title", "categories"]
+
+
+class FacetIndex:
+    """
+    Bitmap indexes over metadata fields for pre-filtering vector search.
+
+    For every (field, value) pair a packed bitmap marks the rows whose metadata has that
+    value; list-valued fields (categories, features, ...) set a bit for each element.
+    A filter ORs the bitmaps of the requested values within a field and ANDs across fields.
+    Rows with no value for a field are indexed under `MISSING`, so a filter can opt in to them.
+    """
+
+    MISSING = "__missing__"
+
+    def __init__(self, count: int, bitmaps: Dict[str, Dict[str, np.ndarray]]):
+        self.count = count
+        self.bitmaps = bitmaps
+
+    @staticmethod
+    def normalize(value) -> List[str]:
+        """Normalize a metadata or filter value into a list of lowercase facet keys."""
+        if value is None:
+            return []
+        if isinstance(value, (list, tuple, set)):
+            return [str(v).lower() for v in value]
+        return [str(value).lower()]
+
+    @classmethod
+    def build(cls, metadatas: List[Dict], fields: List[str]) -> "FacetIndex":
+        """
+        Build bitmaps for the given fields from per-row metadata.
+
+        Args:
+            metadatas (List[Dict]): Metadata dict for each row, in row order
+            fields (List[str]): Metadata fields to index
+
+        Returns:
+            FacetIndex: The facet index
+        """
+        count = len(metadatas)
+        rows_by_value: Dict[str, Dict[str, List[int]]] = {field: {} for field in fields}
+        for row, metadata in enumerate(metadatas):
+            for field in fields:
+                values = cls.normalize(metadata.get(field)) or [cls.MISSING]
+                for value in values:
+                    rows_by_value[field].setdefault(value, []).append(row)
+
+        bitmaps = {}
+        for field, values in rows_by_value.items():
+            bitmaps[field] = {}
+            for value, rows in values.items():
+                bits = np.zeros(count, dtype=bool)
+                bits[rows] = True
+                bitmaps[field][value] = np.packbits(bits)
+        return cls(count, bitmaps)
+
+    def mask(self, filters: Optional[Dict[str, FilterValue]]) -> Optional[np.ndarray]:
+        """
+        Resolve filters into a boolean row mask.
+
+        Args:
+            filters (Dict[str, FilterValue]): Field -> value or list of accepted values
+
+        Returns:
+            Optional[np.ndarray]: Boolean mask over rows, or None when there is nothing to filter
+        """
+        if not filters:
+            return None
+
+        packed_size = (self.count + 7) // 8
+        combined = None
+        for field, accepted in filters.items():
+            field_bitmaps = self.bitmaps.get(field)
+            if field_bitmaps is None:
+                raise ValueError(f"Field '{field}' is not indexed for filtering")
+
+            field_bits = np.zeros(packed_size, dtype=np.uint8)
+            for value in self.normalize(accepted):
+                bitmap = field_bitmaps.get(value)
+                if bitmap is not None:
+                    field_bits |= bitmap
+            combined = field_bits if combined is None else combined & field_bits
+
+        return np.unpackbits(combined, count=self.count).astype(bool)
+
+    def values(self, field: str) -> List[str]:
+        """List the indexed values of a field."""
+        return sorted(v for v in self.bitmaps.get(field, {}) if v != self.MISSING)
+
+    def save(self, path: str):
+        """Save the bitmaps to `<path>.npz` with a JSON key map alongside."""
+        path = Path(path)
+        arrays = {}
+        keys = {"count": self.count, "fields": {}}
+        for field, values in self.bitmaps.items():
+            keys["fields"][field] = {}
+            for i, (value, bitmap) in enumerate(values.items()):
+                name = f"{field}__{i}"
+                arrays[name] = bitmap
+                keys["fields"][field][value] = name
+        np.savez(path.with_suffix(".npz"), **arrays)
+        with open(path.with_suffix(".json"), "w") as f:
+            json.dump(keys, f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, path: str) -> "FacetIndex":
+        """Load bitmaps written by `save`."""
+        path = Path(path)
+        with open(path.with_suffix(".json"), "r") as f:
+            keys = json.load(f)
+        arrays = np.load(path.with_suffix(".npz"))
+        bitmaps = {
+            field: {value: arrays[name] for value, name in values.items()}
+            for field, values in keys["fields"].items()
+        }
+        return cls(keys["count"], bitmaps)
+
+    @classmethod
+    def exists(cls, path: str) -> bool:
+        """Whether a saved facet index exists at `path`."""
+        return Path(path).with_suffix(".json").exists()
@@ -0,0 +1,29 @@
+import gc
+import multiprocessing
+import os
+
+# Load the app (models, indexes) once in the parent and fork workers from it,
+# so model weights and read-only arrays are shared copy-on-write between workers.
+preload_app = True
+worker_class = "uvicorn.workers.UvicornWorker"
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+timeout = int(os.getenv("WORKER_TIMEOUT", "120"))
+keepalive = 5
+
+
+def when_ready(server):
+    # Move everything allocated while loading into the permanent generation so the
+    # garbage collector never writes to those pages and un-shares them in the workers.
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    import torch
+    import main
+
+    # Split the cores between workers instead of every worker using all of them
+    threads = int(os.getenv("TORCH_NUM_THREADS", max(1, multiprocessing.cpu_count() // server.cfg.workers)))
+    torch.set_num_threads(threads)
+
+    main.after_fork()
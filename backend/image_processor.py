@@ -8,10 +8,21 @@ from tqdm import tqdm
 import json
 from transformers import CLIPProcessor, CLIPModel
 from pinecone import Pinecone, ServerlessSpec
+from vector_index import QuantizedIVFIndex
+from index_snapshots import SnapshotManager
+from map_assets import DerivedImageStore
 
 load_dotenv()
 
 class ImageProcessor:
+    # Filename fragment -> resort name, used as a filter facet by MapRAG
+    RESORTS = {
+        "sunshine": "sunshine village",
+        "louise": "lake louise",
+        "palisades": "palisades tahoe",
+        "alpine": "alpine meadows",
+    }
+
     def __init__(self, maps_directory: str = "./data/maps"):
         """
         Initialize the Image Processor to encode images using CLIP and upload to Pinecone.
@@ -27,6 +38,9 @@ class ImageProcessor:
         self.model = CLIPModel.from_pretrained("openai/clip-vit-base-patch32").to(self.device)
         self.processor = CLIPProcessor.from_pretrained("openai/clip-vit-base-patch32")
         
+        # Thumbnails, variants and tile pyramids derived from the maps
+        self.assets = DerivedImageStore()
+        
         # Initialize Pinecone
         self.pc = Pinecone(
             api_key=os.getenv('PINECONE_API_KEY'),
@@ -91,15 +105,8 @@ class ImageProcessor:
             try:
                 vector_id = str(img_path.stem)
                 
-                # Load and process image
-                image = Image.open(img_path)
-                inputs = self.processor(images=image, return_tensors="pt", padding=True)
-                inputs = {k: v.to(self.device) for k, v in inputs.items()}
-                
-                # Generate image embedding
-                with torch.no_grad():
-                    image_features = self.model.get_image_features(**inputs)
-                    image_embedding = image_features.cpu().numpy()[0]
+                # Load the image and generate its embedding
+                image_embedding = self._encode_image(img_path)
                 
                 # Extract metadata
                 metadata = self._extract_metadata(img_path)
@@ -137,15 +144,88 @@ class ImageProcessor:
         print(f"Successfully processed {processed_count} images")
         print(f"Index now contains {self.index.describe_index_stats()['total_vector_count']} vectors")
     
+    def _encode_image(self, img_path: Path, content_hash: str = None) -> np.ndarray:
+        """
+        Compute the CLIP embedding of an image.
+        
+        The derived images are built first, and CLIP reads the small variant instead of
+        decoding the full-size original.
+        """
+        self.assets.build(img_path, content_hash)
+        image = Image.open(self.assets.variant_path(str(img_path), "small") or img_path)
+        inputs = self.processor(images=image, return_tensors="pt", padding=True)
+        inputs = {k: v.to(self.device) for k, v in inputs.items()}
+        
+        with torch.no_grad():
+            image_features = self.model.get_image_features(**inputs)
+            return image_features.cpu().numpy()[0]
+    
+    def build_snapshot(self, activate: bool = True) -> str:
+        """
+        Build a new versioned local map index instead of writing into the live Pinecone index.
+        
+        Images whose content is unchanged since the current snapshot reuse its embeddings.
+        The snapshot is validated and, if activate is set, atomically switched in; running
+        servers pick it up without a restart.
+        
+        Returns:
+            str: The new snapshot version
+        """
+        manager = SnapshotManager("maps")
+        reusable = manager.reusable_embeddings()
+        
+        image_files = sorted(self.maps_directory.glob("*.png"))
+        embeddings = []
+        records = []
+        reused = 0
+        for img_path in tqdm(image_files):
+            content_hash = DerivedImageStore.content_hash(img_path)
+            if content_hash in reusable:
+                embedding = reusable[content_hash]
+                self.assets.build(img_path, content_hash)
+                reused += 1
+            else:
+                embedding = self._encode_image(img_path, content_hash)
+            
+            metadata = self._extract_metadata(img_path)
+            self.metadata[str(img_path)] = metadata
+            embeddings.append(embedding)
+            records.append({
+                "id": img_path.stem,
+                "metadata": {"filepath": str(img_path), **metadata},
+                "hash": content_hash
+            })
+        print(f"Reused {reused} of {len(image_files)} image embeddings")
+        
+        version = manager.new_version()
+        index = QuantizedIVFIndex.build(
+            np.stack(embeddings), records, str(manager.path(version)),
+            nlist=1, facet_fields=["resort", "features", "difficulty_levels"]
+        )
+        report = manager.validate(index)
+        print(f"Built map snapshot {version}: {report}")
+        self._save_metadata()
+        
+        if activate:
+            manager.activate(version)
+        return version
+    
     def _extract_metadata(self, image_path: Path) -> dict:
         """Extract metadata from image filename and any associated metadata files."""
         filename = image_path.stem
         metadata = {
             "name": filename,
+            "resort": None,
             "features": [],
             "difficulty_levels": []
         }
         
+        # Extract resort based on filename
+        for key, resort in self.RESORTS.items():
+            if key in filename.lower():
+                metadata["resort"] = resort
+                break
+        
         # Extract features based on filename
         if "back-side" in filename.lower():
             metadata["features"].append("back side trails")
@@ -158,6 +238,14 @@ class ImageProcessor:
         if "palisades" in filename.lower():
             metadata["features"].append("palisades resort")
         
+        # Difficulty levels use the same labels as MapRAG.extract_features_from_query
+        if "expert terrain" in metadata["features"]:
+            metadata["difficulty_levels"].extend(["black/advanced", "double black/expert"])
+        
+        # Pinecone metadata cannot hold nulls
+        if metadata["resort"] is None:
+            del metadata["resort"]
+        
         return metadata
     
     def _save_metadata(self):
@@ -167,5 +255,14 @@ class ImageProcessor:
             json.dump(self.metadata, f, indent=2)
 
 if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Encode trail maps with CLIP")
+    parser.add_argument("--snapshot", action="store_true",
+                        help="Build a new versioned local snapshot instead of uploading to Pinecone")
+    args = parser.parse_args()
+    
     processor = ImageProcessor()
-    processor.encode_and_upload_images()
+    if args.snapshot:
+        processor.build_snapshot()
+    else:
+        processor.encode_and_upload_images()
@@ -0,0 +1,260 @@
+import os
+import shutil
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from vector_index import QuantizedIVFIndex
+
+
+class SnapshotManager:
+    """
+    Versioned local index builds with an atomically switched "current" pointer.
+
+    Each build goes into its own directory `<root>/<name>/<version>/` next to the one being
+    served. Once validated, the `CURRENT` file is replaced atomically to point at it, and
+    serving processes that watch the pointer (see `SnapshotWatcher`) swap over without a
+    restart. Older versions stay on disk for rollback until pruned.
+    """
+
+    POINTER = "CURRENT"
+
+    def __init__(self, name: str, root: Optional[str] = None):
+        """
+        Args:
+            name (str): Snapshot family, e.g. "text" or "maps"
+            root (str): Base directory, defaults to INDEX_SNAPSHOT_ROOT or data/index/snapshots
+        """
+        self.name = name
+        self.root = Path(root or os.getenv("INDEX_SNAPSHOT_ROOT", "data/index/snapshots")) / name
+
+    @property
+    def pointer_path(self) -> Path:
+        return self.root / self.POINTER
+
+    def new_version(self) -> str:
+        """A fresh, sortable version name."""
+        self.root.mkdir(parents=True, exist_ok=True)
+        return time.strftime("v%Y%m%d-%H%M%S", time.gmtime()) + f"-{os.getpid()}"
+
+    def path(self, version: str) -> Path:
+        return self.root / version
+
+    def current_version(self) -> Optional[str]:
+        """The version being served, or None if nothing was activated yet."""
+        try:
+            return self.pointer_path.read_text().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def current_path(self) -> Optional[Path]:
+        version = self.current_version()
+        return self.path(version) if version else None
+
+    def list_versions(self) -> List[str]:
+        """Complete snapshot versions, oldest first."""
+        if not self.root.exists():
+            return []
+        return sorted(
+            p.name for p in self.root.iterdir()
+            if p.is_dir() and (p / QuantizedIVFIndex.MANIFEST).exists()
+        )
+
+    @staticmethod
+    def validate(index: QuantizedIVFIndex, sample_size: int = 50, min_recall: float = 0.9) -> Dict:
+        """
+        Sanity-check a built index before it is activated.
+
+        Checks that it is non-empty with finite vectors and that sampled vectors find
+        themselves as the top hit.
+
+        Raises:
+            ValueError: If a check fails
+        """
+        if index.count == 0:
+            raise ValueError("Snapshot is empty")
+        rng = np.random.default_rng(0)
+        rows = rng.choice(index.count, min(sample_size, index.count), replace=False)
+        vectors = np.asarray(index.vectors[np.sort(rows)], dtype=np.float32)
+        if not np.isfinite(vectors).all():
+            raise ValueError("Snapshot contains non-finite vectors")
+
+        # Duplicate vectors can legitimately outrank each other, so compare scores too
+        hits = 0
+        for row, vector in zip(np.sort(rows), vectors):
+            results = index.search(vector, k=1)
+            if results and (results[0][0] == row or results[0][1] >= 0.9999):
+                hits += 1
+        recall = hits / len(rows)
+        if recall < min_recall:
+            raise ValueError(f"Snapshot self-recall {recall:.2f} is below {min_recall}")
+        return {"count": index.count, "self_recall": recall}
+
+    def activate(self, version: str):
+        """Atomically point CURRENT at a built snapshot."""
+        if not (self.path(version) / QuantizedIVFIndex.MANIFEST).exists():
+            raise ValueError(f"Snapshot {version} does not exist or is incomplete")
+        tmp_path = self.root / f"{self.POINTER}.tmp"
+        tmp_path.write_text(version)
+        os.replace(tmp_path, self.pointer_path)
+        print(f"Activated {self.name} snapshot {version}")
+
+    def prune(self, keep: int = 3):
+        """Delete old snapshots, keeping the newest `keep` and the current one."""
+        current = self.current_version()
+        versions = self.list_versions()
+        for version in versions[:-keep] if keep else versions:
+            if version != current:
+                shutil.rmtree(self.path(version))
+                print(f"Deleted {self.name} snapshot {version}")
+
+    def reusable_embeddings(self) -> Dict[str, np.ndarray]:
+        """
+        Map content hash -> vector from the current snapshot, so a rebuild only embeds
+        content that changed.
+        """
+        current = self.current_path()
+        if current is None or not (current / "hashes.npy").exists():
+            return {}
+        hashes = np.load(current / "hashes.npy")
+        vectors = np.load(current / "vectors.npy", mmap_mode="r")
+        return {h.decode("ascii"): vectors[i] for i, h in enumerate(hashes)}
+
+
+class SnapshotWatcher:
+    """
+    Serves the current snapshot of a family and swaps to a newly activated one.
+
+    The pointer file is checked at most once per `check_interval` seconds, so the cost on
+    the request path is a clock read and, occasionally, one stat call. `index` is None until
+    a snapshot has been activated and loaded; callers serve from their fallback meanwhile.
+    """
+
+    def __init__(self, manager: SnapshotManager, check_interval: float = 1.0):
+        self.manager = manager
+        self.check_interval = check_interval
+        self.version = None
+        self.index = None
+        self._next_check = 0.0
+        self._pointer_mtime = None
+        self.refresh(force=True)
+
+    def refresh(self, force: bool = False) -> bool:
+        """
+        Load the current snapshot if it changed.
+
+        Returns:
+            bool: Whether a different snapshot is now being served
+        """
+        now = time.monotonic()
+        if not force and now < self._next_check:
+            return False
+        self._next_check = now + self.check_interval
+
+        try:
+            mtime = self.manager.pointer_path.stat().st_mtime_ns
+        except FileNotFoundError:
+            return False
+        if not force and mtime == self._pointer_mtime:
+            return False
+        self._pointer_mtime = mtime
+
+        version = self.manager.current_version()
+        if version is None or version == self.version:
+            return False
+        try:
+            index = QuantizedIVFIndex(str(self.manager.path(version)))
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Could not load {self.manager.name} snapshot {version}, keeping {self.version}: {str(e)}")
+            return False
+
+        # Requests already holding the old index finish on it; it is released once unreferenced
+        self.index, self.version = index, version
+        print(f"Serving {self.manager.name} snapshot {version} ({index.count} vectors)")
+        return True
+
+
+class IndexVersionMarker:
+    """
+    Version marker for an index that is updated in place, such as the Pinecone index.
+
+    Ingest jobs call `bump` after writing to the index; serving processes call `refresh`,
+    which like `SnapshotWatcher` checks the marker file at most once per `check_interval`
+    seconds, and drop results cached from the previous version when it changes.
+    """
+
+    def __init__(self, name: str, root: Optional[str] = None, check_interval: float = 1.0):
+        """
+        Args:
+            name (str): Index name; the marker is `<root>/<name>.version`
+            root (str): Directory of the marker, defaults to INDEX_VERSION_DIR or data/index
+        """
+        self.path = Path(root or os.getenv("INDEX_VERSION_DIR", "data/index")) / f"{name}.version"
+        self.check_interval = check_interval
+        self.version = None
+        self._next_check = 0.0
+        self._mtime = None
+        self.refresh(force=True)
+
+    def bump(self) -> str:
+        """Record that the index changed; returns the new version."""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        version = time.strftime("v%Y%m%d-%H%M%S", time.gmtime()) + f"-{os.getpid()}"
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        tmp_path.write_text(version)
+        os.replace(tmp_path, self.path)
+        self.version = version
+        print(f"Marked index {self.path.stem} as version {version}")
+        return version
+
+    def refresh(self, force: bool = False) -> bool:
+        """
+        Re-read the marker if it changed.
+
+        Returns:
+            bool: Whether the version is different from the one read before
+        """
+        now = time.monotonic()
+        if not force and now < self._next_check:
+            return False
+        self._next_check = now + self.check_interval
+
+        try:
+            mtime = self.path.stat().st_mtime_ns
+        except FileNotFoundError:
+            return False
+        if not force and mtime == self._mtime:
+            return False
+        self._mtime = mtime
+
+        version = self.path.read_text().strip() or None
+        if version == self.version:
+            return False
+        self.version = version
+        return True
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Manage versioned index snapshots")
+    parser.add_argument("command", choices=["list", "activate", "prune"])
+    parser.add_argument("name", help='Snapshot family, e.g. "text" or "maps"')
+    parser.add_argument("version", nargs="?", help="Version to activate")
+    parser.add_argument("--keep", type=int, default=3, help="Snapshots kept by prune")
+    args = parser.parse_args()
+
+    manager = SnapshotManager(args.name)
+    if args.command == "list":
+        current = manager.current_version()
+        for version in manager.list_versions():
+            print(f"{'*' if version == current else ' '} {version}")
+    elif args.command == "activate":
+        if not args.version:
+            parser.error("activate needs a version")
+        manager.validate(QuantizedIVFIndex(str(manager.path(args.version))))
+        manager.activate(args.version)
+    else:
+        manager.prune(keep=args.keep)
@@ -0,0 +1,25 @@
+import argparse
+from wiki_scraper import WikiSkiScraper
+from text_processor import TextProcessor
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stream Wikipedia ski articles straight into the vector index")
+    parser.add_argument("--max-pages", type=int, default=100, help="Maximum number of articles to scrape")
+    parser.add_argument("--batch-size", type=int, default=100, help="Chunks embedded and upserted per batch")
+    parser.add_argument("--save-files", action="store_true",
+                        help="Also write .txt, processed and chunk files to data/texts")
+    parser.add_argument("--no-dedup", action="store_true", help="Keep near-duplicate chunks")
+    args = parser.parse_args()
+    
+    scraper = WikiSkiScraper()
+    processor = TextProcessor()
+    
+    output_dir = str(processor.data_dir) if args.save_files else None
+    articles = scraper.iter_articles(max_pages=args.max_pages, output_dir=output_dir)
+    processor.ingest_stream(articles, batch_size=args.batch_size, save_artifacts=args.save_files,
+                            dedup=not args.no_dedup)
+
+
+if __name__ == "__main__":
+    main()
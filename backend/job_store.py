@@ -0,0 +1,265 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+PENDING = "pending"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+ACTIVE_STATUSES = (PENDING, RUNNING)
+
+
+_owner = {}
+
+
+def _start_ticks(pid: int) -> str:
+    """Start time of a process in clock ticks since boot, or "" where /proc is unavailable."""
+    try:
+        with open(f"/proc/{pid}/stat", "r") as f:
+            # The command name may contain spaces, so split after its closing parenthesis
+            return f.read().rsplit(")", 1)[1].split()[19]
+    except (OSError, IndexError):
+        return ""
+
+
+def owner_token() -> str:
+    """
+    Identifier of this process as a job owner: pid, start time and a random part.
+
+    PIDs repeat, e.g. when a container restarts, so a pid alone would make a new process
+    mistake a dead process's jobs for its own. The token is regenerated after a fork.
+    """
+    pid = os.getpid()
+    if _owner.get("pid") != pid:
+        _owner["pid"] = pid
+        _owner["token"] = f"{pid}-{_start_ticks(pid)}-{uuid.uuid4().hex[:8]}"
+    return _owner["token"]
+
+
+def owner_alive(token: Optional[str]) -> bool:
+    """Whether the process a job owner token belongs to is still running on this host."""
+    if not token:
+        return False
+    if token == owner_token():
+        return True
+    try:
+        pid_text, ticks, _ = token.split("-")
+        pid = int(pid_text)
+    except ValueError:
+        return False
+    # Same pid, different token: an earlier process that had our pid
+    if pid == os.getpid():
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    # A different process that reused the pid started at a different time
+    current_ticks = _start_ticks(pid)
+    return not (ticks and current_ticks and ticks != current_ticks)
+
+
+class JobStore:
+    """
+    Persistent job state in a local SQLite file.
+
+    Jobs survive restarts and are visible to every worker process on the host. Identical
+    active jobs are deduplicated through a caller-supplied key, and a job is claimed
+    atomically before it runs so two workers never execute the same job.
+
+    Every active job records the process that owns it (see `owner_token`), which refreshes
+    a heartbeat while the job is queued or running. Jobs whose owner died or stopped
+    heartbeating are orphans: they are left out of deduplication and adopted by a live worker.
+    """
+
+    def __init__(self, path: Optional[str] = None, heartbeat_timeout: Optional[float] = None):
+        """
+        Args:
+            path (str): SQLite file path, defaults to JOB_STORE_PATH or data/jobs.sqlite3
+            heartbeat_timeout (float): Seconds without a heartbeat after which an active job is
+                orphaned, defaults to JOB_HEARTBEAT_TIMEOUT or 60
+        """
+        self.path = path or os.getenv("JOB_STORE_PATH", "data/jobs.sqlite3")
+        self.heartbeat_timeout = heartbeat_timeout or float(os.getenv("JOB_HEARTBEAT_TIMEOUT", "60"))
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        self._local = threading.local()
+
+    def _connection(self) -> sqlite3.Connection:
+        """Return this thread's connection, reopening it after a fork."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id TEXT PRIMARY KEY, kind TEXT, dedup_key TEXT, status TEXT, stage TEXT, "
+                "progress REAL, request TEXT, result TEXT, error TEXT, "
+                "created_at REAL, updated_at REAL, owner TEXT, heartbeat_at REAL, "
+                "attempts INTEGER DEFAULT 0)"
+            )
+            # Stores created before ownership tracking lack these columns
+            columns = {row["name"] for row in conn.execute("PRAGMA table_info(jobs)")}
+            for column, column_type in (("owner", "TEXT"), ("heartbeat_at", "REAL"),
+                                        ("attempts", "INTEGER DEFAULT 0")):
+                if column not in columns:
+                    conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {column_type}")
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_dedup ON jobs (dedup_key, status)")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @staticmethod
+    def _to_dict(row: sqlite3.Row) -> Dict:
+        job = dict(row)
+        for field in ("request", "result"):
+            job[field] = json.loads(job[field]) if job[field] else None
+        return job
+
+    def create(self, kind: str, request: Dict, dedup_key: str) -> Tuple[Dict, bool]:
+        """
+        Create a pending job owned by this process, or return the live active job with the
+        same dedup key. Orphaned jobs are not reused.
+
+        Returns:
+            Tuple[Dict, bool]: The job and whether it was newly created
+        """
+        conn = self._connection()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT * FROM jobs WHERE dedup_key = ? AND status IN (?, ?) AND heartbeat_at >= ? "
+                "ORDER BY created_at LIMIT 1",
+                (dedup_key, *ACTIVE_STATUSES, now - self.heartbeat_timeout)
+            ).fetchone()
+            if row is not None and not owner_alive(row["owner"]):
+                row = None
+            if row is not None:
+                conn.execute("COMMIT")
+                return self._to_dict(row), False
+
+            job_id = uuid.uuid4().hex
+            conn.execute(
+                "INSERT INTO jobs (id, kind, dedup_key, status, stage, progress, request, created_at, "
+                "updated_at, owner, heartbeat_at, attempts) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 0)",
+                (job_id, kind, dedup_key, PENDING, "queued", 0.0, json.dumps(request), now, now,
+                 owner_token(), now)
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return self.get(job_id), True
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        """Return a job by ID, or None."""
+        row = self._connection().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._to_dict(row) if row else None
+
+    def claim(self, job_id: str) -> bool:
+        """Atomically move a pending job to running in this process; False if another worker got it first."""
+        now = time.time()
+        cursor = self._connection().execute(
+            "UPDATE jobs SET status = ?, stage = ?, updated_at = ?, owner = ?, heartbeat_at = ?, "
+            "attempts = COALESCE(attempts, 0) + 1 WHERE id = ? AND status = ?",
+            (RUNNING, "starting", now, owner_token(), now, job_id, PENDING)
+        )
+        return cursor.rowcount == 1
+
+    def update_progress(self, job_id: str, stage: str, progress: float):
+        """Record the current stage of a running job."""
+        self._connection().execute(
+            "UPDATE jobs SET stage = ?, progress = ?, updated_at = ? WHERE id = ?",
+            (stage, progress, time.time(), job_id)
+        )
+
+    def complete(self, job_id: str, result: Dict):
+        """Mark a job as succeeded with its result."""
+        self._connection().execute(
+            "UPDATE jobs SET status = ?, stage = ?, progress = 1.0, result = ?, updated_at = ? WHERE id = ?",
+            (SUCCEEDED, "done", json.dumps(result), time.time(), job_id)
+        )
+
+    def fail(self, job_id: str, error: str):
+        """Mark a job as failed with an error message."""
+        self._connection().execute(
+            "UPDATE jobs SET status = ?, stage = ?, error = ?, updated_at = ? WHERE id = ?",
+            (FAILED, "failed", error, time.time(), job_id)
+        )
+
+    def heartbeat(self):
+        """Refresh the heartbeat of every active job owned by this process."""
+        self._connection().execute(
+            "UPDATE jobs SET heartbeat_at = ? WHERE owner = ? AND status IN (?, ?)",
+            (time.time(), owner_token(), *ACTIVE_STATUSES)
+        )
+
+    def adopt_orphans(self, max_attempts: int = 3) -> List[str]:
+        """
+        Take over active jobs whose owning process died or stopped heartbeating, including
+        jobs of an earlier process that had this process's pid.
+
+        Orphans are reset to pending and owned by this process; the caller must queue them.
+        Jobs that already ran `max_attempts` times are failed instead, so a job that keeps
+        killing its worker is not retried forever.
+
+        Returns:
+            List[str]: IDs of the adopted jobs
+        """
+        conn = self._connection()
+        now = time.time()
+        token = owner_token()
+        rows = conn.execute(
+            "SELECT id, owner, heartbeat_at, attempts FROM jobs WHERE status IN (?, ?) "
+            "ORDER BY created_at",
+            ACTIVE_STATUSES
+        ).fetchall()
+
+        adopted = []
+        for row in rows:
+            stale = (row["heartbeat_at"] or 0) < now - self.heartbeat_timeout
+            if row["owner"] == token or (not stale and owner_alive(row["owner"])):
+                continue
+            # Compare-and-set on the old owner so two workers never adopt the same job
+            if (row["attempts"] or 0) >= max_attempts:
+                conn.execute(
+                    "UPDATE jobs SET status = ?, stage = ?, error = ?, updated_at = ? "
+                    "WHERE id = ? AND owner IS ? AND heartbeat_at IS ?",
+                    (FAILED, "failed", "The worker running this job stopped", now,
+                     row["id"], row["owner"], row["heartbeat_at"])
+                )
+                continue
+            cursor = conn.execute(
+                "UPDATE jobs SET status = ?, stage = ?, owner = ?, heartbeat_at = ?, updated_at = ? "
+                "WHERE id = ? AND owner IS ? AND heartbeat_at IS ?",
+                (PENDING, "queued", token, now, now, row["id"], row["owner"], row["heartbeat_at"])
+            )
+            if cursor.rowcount == 1:
+                adopted.append(row["id"])
+        return adopted
+
+    def count_active(self, kind: str, owner: Optional[str] = None) -> int:
+        """Number of pending or running jobs of a kind, optionally only those of one owner token."""
+        if owner is None:
+            return self._connection().execute(
+                "SELECT COUNT(*) FROM jobs WHERE kind = ? AND status IN (?, ?)", (kind, *ACTIVE_STATUSES)
+            ).fetchone()[0]
+        return self._connection().execute(
+            "SELECT COUNT(*) FROM jobs WHERE kind = ? AND status IN (?, ?) AND owner = ?",
+            (kind, *ACTIVE_STATUSES, owner)
+        ).fetchone()[0]
+
+    def purge(self, older_than: float):
+        """Delete finished jobs last updated more than `older_than` seconds ago."""
+        self._connection().execute(
+            "DELETE FROM jobs WHERE status IN (?, ?) AND updated_at < ?",
+            (SUCCEEDED, FAILED, time.time() - older_than)
+        )
@@ -0,0 +1,252 @@
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Callable, Dict, Optional
+
+import httpx
+import openai
+from openai import OpenAI
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+class LLMUnavailableError(Exception):
+    """The provider could not serve the call: overloaded, retries exhausted or no capacity left."""
+
+
+class LLMClient:
+    """
+    Shared OpenAI client with connection pooling, timeouts, retries, hedging and back-pressure.
+
+    - One pooled keep-alive HTTP client is shared by every RAG engine in the process.
+    - Each call gets a timeout, and 429/5xx/timeouts are retried with jittered exponential
+      backoff (honouring Retry-After). Image generation has its own, smaller retry budget
+      and is not retried after a timeout, since the timed-out attempt may still be billed.
+    - At most `max_concurrency` calls are in flight; callers wait up to `acquire_timeout`
+      for a slot and then fail fast with LLMUnavailableError.
+    - Optionally, a second attempt is fired when the first runs past the observed p95
+      latency for that operation, and whichever finishes first wins.
+    """
+
+    RETRYABLE_STATUS = {408, 409, 429}
+
+    def __init__(self,
+                 api_key: Optional[str] = None,
+                 max_connections: int = 20,
+                 max_keepalive_connections: int = 10,
+                 keepalive_expiry: float = 30.0,
+                 connect_timeout: float = 5.0,
+                 timeout: float = 60.0,
+                 max_retries: int = 3,
+                 image_max_retries: int = 1,
+                 backoff_base: float = 0.5,
+                 backoff_max: float = 8.0,
+                 max_concurrency: int = 16,
+                 acquire_timeout: float = 10.0,
+                 hedge: bool = False,
+                 hedge_quantile: float = 0.95,
+                 hedge_min_samples: int = 20):
+        self.api_key = api_key or os.getenv("OPENAI_API_KEY")
+        self.max_connections = max_connections
+        self.max_keepalive_connections = max_keepalive_connections
+        self.keepalive_expiry = keepalive_expiry
+        self.connect_timeout = connect_timeout
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.image_max_retries = image_max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.acquire_timeout = acquire_timeout
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.hedge_min_samples = hedge_min_samples
+
+        self.max_concurrency = max_concurrency
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._latencies: Dict[str, deque] = {}
+        self._latency_lock = threading.Lock()
+        self._connect()
+
+    @classmethod
+    def from_env(cls) -> "LLMClient":
+        """Build a client configured from LLM_* environment variables."""
+        return cls(
+            max_connections=int(os.getenv("LLM_MAX_CONNECTIONS", "20")),
+            timeout=float(os.getenv("LLM_TIMEOUT", "60")),
+            max_retries=int(os.getenv("LLM_MAX_RETRIES", "3")),
+            image_max_retries=int(os.getenv("LLM_IMAGE_MAX_RETRIES", "1")),
+            max_concurrency=int(os.getenv("LLM_MAX_CONCURRENCY", "16")),
+            acquire_timeout=float(os.getenv("LLM_ACQUIRE_TIMEOUT", "10")),
+            hedge=os.getenv("LLM_HEDGE", "0") == "1",
+        )
+
+    def _connect(self):
+        """Create the pooled HTTP client, the OpenAI client on top of it and the hedging pool."""
+        self._hedge_pool = ThreadPoolExecutor(max_workers=self.max_concurrency * 2, thread_name_prefix="llm-hedge")
+        self._http = httpx.Client(
+            limits=httpx.Limits(
+                max_connections=self.max_connections,
+                max_keepalive_connections=self.max_keepalive_connections,
+                keepalive_expiry=self.keepalive_expiry,
+            ),
+            timeout=httpx.Timeout(self.timeout, connect=self.connect_timeout),
+        )
+        # Retries are handled here so they can share the backoff and concurrency budget
+        self.openai = OpenAI(api_key=self.api_key, http_client=self._http, max_retries=0)
+
+    def reset(self):
+        """Drop pooled connections and threads, e.g. in a worker forked from a process that used them."""
+        self._connect()
+
+    def chat_completion(self, timeout: Optional[float] = None, hedge: Optional[bool] = None, **kwargs):
+        """
+        Create a chat completion.
+
+        Args:
+            timeout (float): Per-attempt timeout in seconds, defaults to the client timeout
+            hedge (bool): Override the client's hedging setting for this call
+            **kwargs: Arguments for `chat.completions.create`
+
+        Returns:
+            The OpenAI chat completion response
+        """
+        return self._call(
+            "chat",
+            lambda: self.openai.chat.completions.create(timeout=timeout or self.timeout, **kwargs),
+            hedge=self.hedge if hedge is None else hedge,
+        )
+
+    def generate_image(self, timeout: Optional[float] = None, **kwargs):
+        """
+        Generate an image. Image calls are never hedged since every attempt is billed, and
+        only retried (up to `image_max_retries` times) on errors where no image was made.
+
+        Args:
+            timeout (float): Per-attempt timeout in seconds, defaults to 1.5x the client timeout
+            **kwargs: Arguments for `images.generate`
+
+        Returns:
+            The OpenAI image response
+        """
+        return self._call(
+            "image",
+            lambda: self.openai.images.generate(timeout=timeout or self.timeout * 1.5, **kwargs),
+            hedge=False,
+            max_retries=self.image_max_retries,
+            retry_timeouts=False,
+        )
+
+    def _call(self, operation: str, fn: Callable, hedge: bool,
+              max_retries: Optional[int] = None, retry_timeouts: bool = True):
+        """
+        Run `fn` under the concurrency limit with retries (and hedging if enabled).
+
+        Args:
+            max_retries (int): Retries after the first attempt, defaults to the client setting
+            retry_timeouts (bool): Whether a timed-out attempt is retried
+        """
+        max_retries = self.max_retries if max_retries is None else max_retries
+        if not self._slots.acquire(timeout=self.acquire_timeout):
+            raise LLMUnavailableError("Too many concurrent LLM requests, try again shortly")
+        try:
+            for attempt in range(max_retries + 1):
+                try:
+                    if hedge:
+                        return self._hedged(operation, fn)
+                    return self._timed(operation, fn)
+                except Exception as e:
+                    if not self._is_retryable(e):
+                        raise
+                    if isinstance(e, openai.APITimeoutError) and not retry_timeouts:
+                        raise LLMUnavailableError(f"LLM {operation} call timed out: {str(e)}") from e
+                    if attempt == max_retries:
+                        raise LLMUnavailableError(f"LLM provider unavailable after {attempt + 1} attempts: {str(e)}") from e
+                    delay = self._backoff(attempt, e)
+                    print(f"LLM {operation} call failed ({str(e)}), retrying in {delay:.2f}s")
+                    time.sleep(delay)
+        finally:
+            self._slots.release()
+
+    def _timed(self, operation: str, fn: Callable):
+        """Run `fn` and record its latency when it succeeds."""
+        start = time.monotonic()
+        result = fn()
+        with self._latency_lock:
+            self._latencies.setdefault(operation, deque(maxlen=200)).append(time.monotonic() - start)
+        return result
+
+    def _hedge_delay(self, operation: str) -> Optional[float]:
+        """Latency quantile after which a hedged attempt is sent, once enough samples exist."""
+        with self._latency_lock:
+            samples = sorted(self._latencies.get(operation, ()))
+        if len(samples) < self.hedge_min_samples:
+            return None
+        return samples[min(len(samples) - 1, int(self.hedge_quantile * len(samples)))]
+
+    def _hedged(self, operation: str, fn: Callable):
+        """Send a second attempt if the first is slower than usual; return the first success."""
+        delay = self._hedge_delay(operation)
+        if delay is None:
+            return self._timed(operation, fn)
+
+        first = self._hedge_pool.submit(self._timed, operation, fn)
+        done, _ = wait([first], timeout=delay)
+        if done:
+            return first.result()
+
+        # Only hedge with spare capacity, so hedging never adds load when we are saturated
+        if not self._slots.acquire(blocking=False):
+            return first.result()
+
+        def hedge_attempt():
+            try:
+                return self._timed(operation, fn)
+            finally:
+                self._slots.release()
+
+        second = self._hedge_pool.submit(hedge_attempt)
+        pending = {first, second}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    def _is_retryable(self, error: Exception) -> bool:
+        """Whether an error is transient: timeouts, connection errors, 408/409/429 and 5xx."""
+        if isinstance(error, (openai.APITimeoutError, openai.APIConnectionError)):
+            return True
+        if isinstance(error, openai.APIStatusError):
+            return error.status_code in self.RETRYABLE_STATUS or error.status_code >= 500
+        return False
+
+    def _backoff(self, attempt: int, error: Exception) -> float:
+        """Full-jitter exponential backoff, or the provider's Retry-After when it sends one."""
+        if isinstance(error, openai.APIStatusError):
+            retry_after = error.response.headers.get("retry-after")
+            if retry_after:
+                try:
+                    return min(float(retry_after), self.backoff_max)
+                except ValueError:
+                    pass
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+
+_shared_client: Optional[LLMClient] = None
+_shared_client_lock = threading.Lock()
+
+
+def get_llm_client() -> LLMClient:
+    """Return the process-wide LLM client, creating it on first use."""
+    global _shared_client
+    with _shared_client_lock:
+        if _shared_client is None:
+            _shared_client = LLMClient.from_env()
+        return _shared_client
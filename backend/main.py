@@ -1,10 +1,29 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request, Header, Depends
+from fastapi.responses import StreamingResponse, FileResponse, Response
+from fastapi.concurrency import run_in_threadpool
+import anyio
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from encyclopedia_rag import EncyclopediaRAG
-from map_rag import MapRAG
+from map_rag import MapRAG, MapGenerationError
+from map_jobs import MapJobRunner, QueueFullError
+from job_store import SUCCEEDED, FAILED
+from scheduler import WorkloadScheduler, AdmissionRejected
+from conversation import ConversationManager
+from prefetch import PrefetchManager, PrefetchRateLimited
+from llm_client import get_llm_client, LLMUnavailableError
+from map_assets import MEDIA_TYPES
+from facet_index import TEXT_FACET_FIELDS
+from profiling import Profiler
 import uvicorn
-from typing import Optional
+import asyncio
+import hashlib
+import hmac
+import json
+import os
+import threading
+from collections import OrderedDict
+from typing import Optional, Dict, List
 
 app = FastAPI()
 
@@ -20,24 +39,115 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Initialize RAG manager
+# Initialize RAG manager. Under gunicorn --preload this runs once in the parent process
+# and the workers share the loaded models and index arrays copy-on-write.
 encyclopedia_rag = EncyclopediaRAG()
 map_rag = MapRAG()
+conversations = ConversationManager(encyclopedia_rag)
+
+# Separate concurrency pools and queues per modelType so map traffic cannot starve text chat
+scheduler = WorkloadScheduler.from_env()
+map_jobs = MapJobRunner(map_rag, scheduler=scheduler)
+
+# Speculative retrieval for drafts the user is still typing
+prefetcher = PrefetchManager(encyclopedia_rag, map_rag, scheduler=scheduler)
+
+# Admin-only request profiling and memory diagnostics, idle unless armed
+profiler = Profiler()
+
+def after_fork():
+    """Reset per-process state in a freshly forked worker"""
+    get_llm_client().reset()
+    encyclopedia_rag.reconnect()
+    map_rag.reconnect()
+
 class ChatRequest(BaseModel):
     message: str
     modelType: str
+    # Optional metadata filters for encyclopedia retrieval, e.g. {"categories": ["Alpine skiing"]}
+    filters: Optional[Dict[str, List[str]]] = None
+    # Conversation ID; when set, encyclopedia answers use the session's history
+    chatId: Optional[str] = None
+    # Prefetch session ID the drafts of this message were sent with
+    prefetchId: Optional[str] = None
+
+class MapJobRequest(BaseModel):
+    message: str
+    difficultyLevel: str = "intermediate"
+    size: str = "1024x1024"
+    prefetchId: Optional[str] = None
+
+class PrefetchRequest(BaseModel):
+    prefetchId: str
+    message: str
+    modelType: str
+    # Increasing per draft so an older draft never replaces a newer one
+    seq: int
+    filters: Optional[Dict[str, List[str]]] = None
+
+class ProfileRequest(BaseModel):
+    # Number of /api/chat requests to profile in the worker that receives this call
+    requests: int = 10
+    # Fraction of requests profiled while armed
+    sampleRate: float = 1.0
+
+@app.on_event("startup")
+def recover_map_jobs():
+    """Resume map jobs interrupted by a restart and start the orphaned-job sweep"""
+    map_jobs.recover()
+
+@app.on_event("startup")
+def warm_caches():
+    """Load precomputed answers for frequent questions in the background"""
+    path = os.getenv("WARM_CACHE_PATH", "data/warm_cache.json")
+    threading.Thread(target=encyclopedia_rag.warm_from, args=(path,), daemon=True).start()
+
+@app.on_event("startup")
+def size_thread_pool():
+    """Give the threadpool room for every admitted and queued request so queued work cannot block other lanes"""
+    limiter = anyio.to_thread.current_default_thread_limiter()
+    limiter.total_tokens = max(limiter.total_tokens, scheduler.thread_budget() + 10)
+
+def _check_filters(filters: Optional[Dict[str, List[str]]]):
+    """Reject filters on fields the encyclopedia index does not facet on"""
+    unknown = sorted(set(filters or {}) - set(TEXT_FACET_FIELDS))
+    if unknown:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Cannot filter on {', '.join(unknown)}; filterable fields are {', '.join(TEXT_FACET_FIELDS)}"
+        )
 
 @app.post("/api/chat")
 async def chat(request: ChatRequest):
     """Handle chat requests using RAG system"""
     if not request.message:
         raise HTTPException(status_code=400, detail="Message cannot be empty")
+    _check_filters(request.filters)
     
     try:
-        if request.modelType == "encyclopedia":
-            response = encyclopedia_rag.generate_response(request.message)
+        prefetched = None
+        if request.modelType in ("encyclopedia", "map"):
+            # SQLite reads stay off the event loop
+            prefetched = await run_in_threadpool(
+                prefetcher.take, request.prefetchId, request.modelType, request.message, request.filters
+            )
+        
+        if request.modelType == "encyclopedia" and request.chatId:
+            response = await run_in_threadpool(
+                scheduler.run, "encyclopedia", profiler.wrap("chat-encyclopedia", conversations.respond),
+                request.chatId, request.message, filters=request.filters, prefetched=prefetched
+            )
+        elif request.modelType == "encyclopedia":
+            response = await run_in_threadpool(
+                scheduler.run, "encyclopedia", profiler.wrap("chat-encyclopedia", encyclopedia_rag.generate_response),
+                request.message, filters=request.filters,
+                matches=prefetched["matches"] if prefetched else None
+            )
         elif request.modelType == "map":
-            response = map_rag.generate_enhanced_map(request.message)
+            response = await run_in_threadpool(
+                scheduler.run, "map", profiler.wrap("chat-map", map_rag.generate_enhanced_map), request.message,
+                references=prefetched["references"] if prefetched else None
+            )
         else:
             raise HTTPException(status_code=400, detail="Invalid model type")
         
@@ -52,6 +162,30 @@ async def chat(request: ChatRequest):
             "status": "success"
         }
         
+    except HTTPException:
+        raise
+        
+    except AdmissionRejected as e:
+        # Shed load quickly instead of letting the request time out in a queue
+        raise HTTPException(
+            status_code=e.status_code,
+            detail=str(e),
+            headers={"Retry-After": str(e.retry_after)}
+        )
+        
+    except MapGenerationError as e:
+        print(f"Map generation failed: {str(e)}")
+        raise HTTPException(status_code=502, detail=str(e))
+        
+    except LLMUnavailableError as e:
+        # Provider overloaded or unreachable: tell the client to retry instead of a generic 500
+        print(f"LLM unavailable: {str(e)}")
+        raise HTTPException(
+            status_code=503,
+            detail="The language model is temporarily unavailable, please try again shortly",
+            headers={"Retry-After": "5"}
+        )
+        
     except Exception as e:
         # Log the full error
         print(f"Error processing request: {str(e)}")
@@ -62,5 +196,215 @@ async def chat(request: ChatRequest):
             detail=f"An error occurred processing your request: {str(e)}"
         )
 
+@app.post("/api/prefetch", status_code=202)
+async def prefetch(request: PrefetchRequest, http_request: Request):
+    """Start retrieval for a draft message in the background; the final /api/chat can reuse it"""
+    _check_filters(request.filters)
+    client = http_request.client.host if http_request.client else None
+    try:
+        return await run_in_threadpool(
+            prefetcher.submit, request.prefetchId, request.modelType, request.message, request.seq,
+            request.filters, client=client
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except PrefetchRateLimited as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": "1"})
+
+@app.get("/api/metrics/scheduler")
+async def scheduler_metrics():
+    """Per-lane load, shedding counts and queue-wait percentiles"""
+    return scheduler.stats()
+
+@app.get("/api/metrics/prefetch")
+async def prefetch_metrics():
+    """Prefetch scheduling, supersession and reuse counts"""
+    return prefetcher.stats()
+
+def _job_response(job: dict) -> dict:
+    """Public view of a map job"""
+    return {
+        "jobId": job["id"],
+        "status": job["status"],
+        "stage": job["stage"],
+        "progress": job["progress"],
+        "response": (job["result"] or {}).get("url"),
+        "error": job["error"]
+    }
+
+@app.post("/api/map/jobs", status_code=202)
+async def submit_map_job(request: MapJobRequest):
+    """Queue a map generation and return its job ID immediately"""
+    if not request.message:
+        raise HTTPException(status_code=400, detail="Message cannot be empty")
+    # The job store and prefetch cache are SQLite; a locked database must not stall the event loop
+    prefetched = await run_in_threadpool(prefetcher.take, request.prefetchId, "map", request.message)
+    try:
+        job, created = await run_in_threadpool(
+            map_jobs.submit, request.message, request.difficultyLevel, request.size,
+            references=prefetched["references"] if prefetched else None
+        )
+    except QueueFullError as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": "10"})
+    except AdmissionRejected as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+    return {**_job_response(job), "deduplicated": not created}
+
+@app.get("/api/map/jobs/{job_id}")
+async def get_map_job(job_id: str):
+    """Poll the state of a map job"""
+    job = await run_in_threadpool(map_jobs.store.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return _job_response(job)
+
+@app.get("/api/map/jobs/{job_id}/events")
+async def map_job_events(job_id: str):
+    """Stream map job progress as server-sent events until the job finishes"""
+    if await run_in_threadpool(map_jobs.store.get, job_id) is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    
+    async def events():
+        last = None
+        while True:
+            job = _job_response(await run_in_threadpool(map_jobs.store.get, job_id))
+            if job != last:
+                yield f"data: {json.dumps(job)}\n\n"
+                last = job
+            if job["status"] in (SUCCEEDED, FAILED):
+                return
+            await asyncio.sleep(0.5)
+    
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+# Derived map files never change under their content-hash path, so clients may cache them forever
+ASSET_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+def _asset_url(content_hash: str, file_path: str) -> str:
+    return f"/api/maps/assets/{content_hash}/{file_path}"
+
+@app.get("/api/maps")
+async def list_maps():
+    """Trail maps with URLs of their thumbnails, variants and DeepZoom descriptors"""
+    maps = []
+    for manifest in map_rag.assets.list_maps():
+        content_hash = manifest["hash"]
+        maps.append({
+            "id": content_hash,
+            "source": manifest["source"],
+            "width": manifest["width"],
+            "height": manifest["height"],
+            "thumbnail": _asset_url(content_hash, manifest["variants"]["thumbnail"]["files"]["webp"]),
+            "variants": {
+                name: {ext: _asset_url(content_hash, filename) for ext, filename in variant["files"].items()}
+                for name, variant in manifest["variants"].items()
+            },
+            "dzi": _asset_url(content_hash, manifest["dzi"]["file"]),
+        })
+    return maps
+
+@app.get("/api/maps/assets/{content_hash}/{file_path:path}")
+async def map_asset(content_hash: str, file_path: str, request: Request):
+    """Serve a thumbnail, variant or tile with a strong ETag; FileResponse handles Range requests"""
+    path = map_rag.assets.resolve(content_hash, file_path)
+    if path is None or path.suffix not in MEDIA_TYPES:
+        raise HTTPException(status_code=404, detail="Map asset not found")
+    
+    etag = '"' + hashlib.sha1(f"{content_hash}/{file_path}".encode("utf-8")).hexdigest()[:20] + '"'
+    headers = {"ETag": etag, "Cache-Control": ASSET_CACHE_CONTROL}
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=headers)
+    return FileResponse(path, media_type=MEDIA_TYPES[path.suffix], headers=headers)
+
+def require_admin(x_admin_token: Optional[str] = Header(None)):
+    """Allow a request only with the ADMIN_TOKEN; the admin endpoints do not exist without one"""
+    admin_token = os.getenv("ADMIN_TOKEN")
+    if not admin_token:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not x_admin_token or not hmac.compare_digest(x_admin_token, admin_token):
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+def _embedding_model():
+    """The SentenceTransformer behind the chromadb embedding function, if it can be found"""
+    function = encyclopedia_rag.embedding_function
+    model = getattr(function, "_model", None)
+    if model is None:
+        model = next(iter(getattr(function, "models", {}).values()), None)
+    return model
+
+@app.post("/api/admin/profile/start", dependencies=[Depends(require_admin)])
+async def start_profiling(request: ProfileRequest):
+    """Profile the next N chat requests handled by this worker"""
+    if request.requests < 1 or not 0 < request.sampleRate <= 1:
+        raise HTTPException(status_code=400, detail="requests must be positive and sampleRate in (0, 1]")
+    profiler.start(request.requests, request.sampleRate)
+    return {"pid": os.getpid(), "remaining": profiler.remaining}
+
+@app.post("/api/admin/profile/stop", dependencies=[Depends(require_admin)])
+async def stop_profiling():
+    profiler.stop()
+    return {"pid": os.getpid(), "remaining": 0}
+
+@app.get("/api/admin/profile", dependencies=[Depends(require_admin)])
+async def profiling_status():
+    """Armed state, recent captures with their top functions, and downloadable dumps"""
+    return {
+        "pid": os.getpid(),
+        "remaining": profiler.remaining,
+        "sampleRate": profiler.sample_rate,
+        "captures": list(profiler.captures),
+        "dumps": profiler.list_dumps()
+    }
+
+@app.get("/api/admin/profile/dumps/{name}", dependencies=[Depends(require_admin)])
+async def download_dump(name: str):
+    path = profiler.dump_path(name)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Dump not found")
+    return FileResponse(path, media_type="application/octet-stream", filename=name)
+
+@app.get("/api/admin/memory", dependencies=[Depends(require_admin)])
+async def memory_report():
+    """RSS, in-process cache and model sizes, and torch thread settings of this worker"""
+    models = {"clip": map_rag.model}
+    embedding_model = _embedding_model()
+    if embedding_model is not None:
+        models["sentence_transformer"] = embedding_model
+    # Copies, so request threads can keep updating the caches while they are measured
+    with encyclopedia_rag.cache_lock:
+        caches = {
+            "embedding_cache": OrderedDict(encyclopedia_rag.embedding_cache),
+            "retrieval_cache": OrderedDict(encyclopedia_rag.retrieval_cache),
+            "answer_cache": OrderedDict(encyclopedia_rag.answer_cache),
+        }
+    caches.update({
+        "map_metadata": map_rag.metadata,
+        "shared_cache": encyclopedia_rag.shared_cache,
+    })
+    return await run_in_threadpool(Profiler.memory_report, caches, models)
+
+@app.post("/api/admin/memory/tracemalloc/start", dependencies=[Depends(require_admin)])
+async def start_tracemalloc(frames: int = 25):
+    """Start tracing allocations; this slows the worker down until stopped"""
+    profiler.start_tracemalloc(frames)
+    return {"pid": os.getpid(), "tracing": True}
+
+@app.post("/api/admin/memory/tracemalloc/stop", dependencies=[Depends(require_admin)])
+async def stop_tracemalloc():
+    profiler.stop_tracemalloc()
+    return {"pid": os.getpid(), "tracing": False}
+
+@app.post("/api/admin/memory/snapshot", dependencies=[Depends(require_admin)])
+async def memory_snapshot(top: int = 30):
+    """Dump a tracemalloc snapshot and report the top allocation sites, or growth since the last snapshot"""
+    try:
+        return {"pid": os.getpid(), **await run_in_threadpool(profiler.snapshot, top)}
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
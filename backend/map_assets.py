@@ -0,0 +1,252 @@
+import hashlib
+import json
+import math
+import os
+import shutil
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from PIL import Image
+
+# Derived variants: name -> longest side in pixels
+VARIANTS = {
+    "thumbnail": 256,
+    # Enough for CLIP's 224px input, even for wide maps
+    "small": 512,
+    # Larger preview for API clients (see GET /api/maps)
+    "medium": 1024,
+}
+VARIANT_FORMATS = {"webp": "WEBP", "jpg": "JPEG"}
+
+TILE_SIZE = 254
+TILE_OVERLAP = 1
+TILE_FORMAT = "jpg"
+
+MEDIA_TYPES = {
+    ".webp": "image/webp",
+    ".jpg": "image/jpeg",
+    ".dzi": "application/xml",
+    ".json": "application/json",
+}
+
+
+class DerivedImageStore:
+    """
+    Downscaled variants and DeepZoom tile pyramids of the trail maps, built at ingest time.
+
+    Everything derived from one original lives in `<root>/<content hash>/`, so the files are
+    immutable: rebuilding an unchanged map is a no-op, and a changed map gets a new directory.
+    `index.json` maps each original's file name to its current hash. Layout per map:
+
+        manifest.json                 size, hash and the files below
+        thumbnail.webp / .jpg         variants, see VARIANTS
+        small.webp / .jpg
+        medium.webp / .jpg
+        map.dzi                       DeepZoom descriptor
+        map_files/<level>/<col>_<row>.jpg
+    """
+
+    INDEX = "index.json"
+    MANIFEST = "manifest.json"
+
+    def __init__(self, root: Optional[str] = None):
+        """
+        Args:
+            root (str): Directory holding the derived images, defaults to MAP_ASSET_DIR or
+                data/maps/derived next to this module
+        """
+        default_root = Path(__file__).resolve().parent / "data" / "maps" / "derived"
+        self.root = Path(root or os.getenv("MAP_ASSET_DIR", default_root))
+        self._index = None
+        self._index_mtime = None
+
+    @staticmethod
+    def content_hash(path: Path) -> str:
+        """SHA-1 of a file's bytes, read in blocks."""
+        digest = hashlib.sha1()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        return digest.hexdigest()
+
+    @staticmethod
+    def _rgb(image: Image.Image) -> Image.Image:
+        """Flatten transparency onto white; JPEG has no alpha channel."""
+        if image.mode in ("RGBA", "LA", "P"):
+            image = image.convert("RGBA")
+            background = Image.new("RGB", image.size, (255, 255, 255))
+            background.paste(image, mask=image.getchannel("A"))
+            return background
+        return image.convert("RGB")
+
+    @staticmethod
+    def _save(image: Image.Image, path: Path, fmt: str):
+        if fmt == "WEBP":
+            image.save(path, fmt, quality=80, method=4)
+        else:
+            image.save(path, fmt, quality=85, optimize=True, progressive=True)
+
+    def _build_variants(self, image: Image.Image, out_dir: Path) -> Dict[str, Dict]:
+        variants = {}
+        for name, max_side in VARIANTS.items():
+            resized = image.copy()
+            resized.thumbnail((max_side, max_side), Image.LANCZOS)
+            files = {}
+            for ext, fmt in VARIANT_FORMATS.items():
+                filename = f"{name}.{ext}"
+                self._save(resized, out_dir / filename, fmt)
+                files[ext] = filename
+            variants[name] = {"width": resized.width, "height": resized.height, "files": files}
+        return variants
+
+    def _build_tiles(self, image: Image.Image, out_dir: Path) -> Dict:
+        """Write a DeepZoom pyramid: level max_level is full size, each level below is half as large."""
+        width, height = image.size
+        max_level = math.ceil(math.log2(max(width, height)))
+        tiles_dir = out_dir / "map_files"
+
+        level_image = image
+        for level in range(max_level, -1, -1):
+            scale = 2 ** (max_level - level)
+            level_size = (max(1, math.ceil(width / scale)), max(1, math.ceil(height / scale)))
+            if level_image.size != level_size:
+                level_image = level_image.resize(level_size, Image.LANCZOS)
+
+            level_dir = tiles_dir / str(level)
+            level_dir.mkdir(parents=True, exist_ok=True)
+            for col in range(math.ceil(level_size[0] / TILE_SIZE)):
+                for row in range(math.ceil(level_size[1] / TILE_SIZE)):
+                    box = (
+                        max(0, col * TILE_SIZE - TILE_OVERLAP),
+                        max(0, row * TILE_SIZE - TILE_OVERLAP),
+                        min(level_size[0], (col + 1) * TILE_SIZE + TILE_OVERLAP),
+                        min(level_size[1], (row + 1) * TILE_SIZE + TILE_OVERLAP),
+                    )
+                    self._save(level_image.crop(box), level_dir / f"{col}_{row}.{TILE_FORMAT}", "JPEG")
+
+        descriptor = (
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            f'<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" Format="{TILE_FORMAT}" '
+            f'Overlap="{TILE_OVERLAP}" TileSize="{TILE_SIZE}">\n'
+            f'  <Size Width="{width}" Height="{height}"/>\n'
+            '</Image>\n'
+        )
+        (out_dir / "map.dzi").write_text(descriptor)
+        return {"file": "map.dzi", "max_level": max_level, "tile_size": TILE_SIZE, "overlap": TILE_OVERLAP}
+
+    def build(self, image_path: Path, content_hash: Optional[str] = None) -> Dict:
+        """
+        Build (or reuse) the derived images of one map.
+
+        Args:
+            image_path (Path): Original image
+            content_hash (str): Hash of the original if already computed
+
+        Returns:
+            Dict: The map's manifest
+        """
+        image_path = Path(image_path)
+        content_hash = content_hash or self.content_hash(image_path)
+        out_dir = self.root / content_hash
+        manifest_path = out_dir / self.MANIFEST
+
+        if manifest_path.exists():
+            with open(manifest_path, "r") as f:
+                manifest = json.load(f)
+        else:
+            # Build into a temporary directory so a partial build is never served
+            tmp_dir = self.root / f".{content_hash}.tmp-{os.getpid()}"
+            tmp_dir.mkdir(parents=True, exist_ok=True)
+            with Image.open(image_path) as original:
+                image = self._rgb(original)
+            manifest = {
+                "hash": content_hash,
+                "source": image_path.name,
+                "width": image.width,
+                "height": image.height,
+                "variants": self._build_variants(image, tmp_dir),
+                "dzi": self._build_tiles(image, tmp_dir),
+            }
+            with open(tmp_dir / self.MANIFEST, "w") as f:
+                json.dump(manifest, f, indent=2)
+            try:
+                os.replace(tmp_dir, out_dir)
+            except OSError:
+                # Another build of the same content finished first
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+            print(f"Built derived images for {image_path.name} ({content_hash[:12]})")
+
+        self._update_index(image_path.name, content_hash)
+        return manifest
+
+    def _load_index(self) -> Dict[str, str]:
+        """Source file name -> content hash, reloaded when the file changes."""
+        index_path = self.root / self.INDEX
+        try:
+            mtime = index_path.stat().st_mtime_ns
+        except FileNotFoundError:
+            return {}
+        if mtime != self._index_mtime:
+            with open(index_path, "r") as f:
+                self._index = json.load(f)
+            self._index_mtime = mtime
+        return self._index
+
+    def _update_index(self, source: str, content_hash: str):
+        index = dict(self._load_index())
+        if index.get(source) == content_hash:
+            return
+        index[source] = content_hash
+        tmp_path = self.root / f"{self.INDEX}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(index, f, indent=2)
+        os.replace(tmp_path, self.root / self.INDEX)
+
+    def manifest(self, content_hash: str) -> Optional[Dict]:
+        manifest_path = self.root / content_hash / self.MANIFEST
+        if not manifest_path.exists():
+            return None
+        with open(manifest_path, "r") as f:
+            return json.load(f)
+
+    def list_maps(self) -> List[Dict]:
+        """Manifests of all current maps."""
+        manifests = (self.manifest(content_hash) for content_hash in self._load_index().values())
+        return [manifest for manifest in manifests if manifest is not None]
+
+    def variant_path(self, image_path: str, name: str, ext: str = "jpg") -> Optional[Path]:
+        """
+        Path of a derived variant of an original map, or None if it was not built.
+
+        Args:
+            image_path (str): Path (or file name) of the original map
+            name (str): Variant name, see VARIANTS
+            ext (str): "jpg" or "webp"
+        """
+        content_hash = self._load_index().get(os.path.basename(image_path))
+        if content_hash is None:
+            return None
+        path = self.root / content_hash / f"{name}.{ext}"
+        return path if path.exists() else None
+
+    def resolve(self, content_hash: str, relative_path: str) -> Optional[Path]:
+        """Safely map a request for `<hash>/<relative path>` to a file in the store."""
+        if not content_hash.isalnum():
+            return None
+        base = (self.root / content_hash).resolve()
+        path = (base / relative_path).resolve()
+        if base not in path.parents or not path.is_file():
+            return None
+        return path
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Build thumbnails, variants and tile pyramids for the trail maps")
+    parser.add_argument("--maps-dir", default=str(Path(__file__).resolve().parent / "data" / "maps"))
+    args = parser.parse_args()
+
+    store = DerivedImageStore()
+    for image_path in sorted(Path(args.maps_dir).glob("*.png")):
+        store.build(image_path)
@@ -0,0 +1,185 @@
+import hashlib
+import math
+import os
+import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from job_store import JobStore, owner_token
+from scheduler import BACKGROUND, AdmissionRejected
+
+MAP_JOB_KIND = "map"
+
+
+class QueueFullError(Exception):
+    """Too many map jobs are already waiting."""
+
+
+class MapJobRunner:
+    """
+    Runs map generation jobs on a bounded local worker pool.
+
+    Submitting returns immediately with a job ID; the job's progress and result are kept in
+    the JobStore, where the API polls them. Submitting the same request while an identical
+    job is still pending or running returns the existing job instead of generating twice.
+
+    Jobs have a pending-time budget. A submission is rejected when the jobs already queued in
+    this worker would keep it waiting longer than the budget, estimated from recent
+    generation times, and a job that still waits past its budget is failed instead of run.
+    """
+
+    def __init__(self, map_rag, store: Optional[JobStore] = None,
+                 max_workers: Optional[int] = None, max_active: Optional[int] = None,
+                 scheduler=None):
+        """
+        Args:
+            map_rag (MapRAG): Engine used to run the jobs
+            scheduler (WorkloadScheduler): Optional scheduler whose "map" lane the jobs run
+                through at background priority, behind interactive map requests
+            store (JobStore): Job state store, defaults to a JobStore at JOB_STORE_PATH
+            max_workers (int): Concurrent generations, defaults to MAP_JOB_WORKERS or 2
+            max_active (int): Pending + running jobs accepted before rejecting, defaults to
+                MAP_JOB_MAX_ACTIVE or 50
+
+        The pending-time budget is MAP_JOB_MAX_WAIT seconds (default 120). Until generations
+        have been timed, each is assumed to take MAP_JOB_EXPECTED_SECONDS (default 20).
+        """
+        self.map_rag = map_rag
+        self.store = store or JobStore()
+        self.max_workers = max_workers or int(os.getenv("MAP_JOB_WORKERS", "2"))
+        self.max_active = max_active or int(os.getenv("MAP_JOB_MAX_ACTIVE", "50"))
+        self.scheduler = scheduler
+        self.max_wait = float(os.getenv("MAP_JOB_MAX_WAIT", "120"))
+        self.expected_seconds = float(os.getenv("MAP_JOB_EXPECTED_SECONDS", "20"))
+        self._durations = deque(maxlen=50)
+        self.sweep_interval = float(os.getenv("JOB_HEARTBEAT_INTERVAL", "10"))
+        self._pool = None
+        self._sweeper = None
+        self._stop = threading.Event()
+
+    @property
+    def pool(self) -> ThreadPoolExecutor:
+        # Created on first use so no threads exist before gunicorn forks the workers
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="map-job")
+        return self._pool
+
+    @staticmethod
+    def dedup_key(request: Dict) -> str:
+        """Key identifying equivalent requests: same normalized query and parameters."""
+        query = re.sub(r"\s+", " ", request["query"].strip().lower())
+        params = f"{query}|{request.get('difficulty_level')}|{request.get('size')}"
+        return hashlib.sha1(params.encode("utf-8")).hexdigest()
+
+    def generation_seconds(self) -> float:
+        """Median duration of recent generations in this worker, or the configured estimate."""
+        durations = sorted(self._durations)
+        return durations[len(durations) // 2] if durations else self.expected_seconds
+
+    def expected_wait(self) -> float:
+        """Seconds a job submitted now would stay pending behind this worker's active jobs."""
+        ahead = self.store.count_active(MAP_JOB_KIND, owner=owner_token())
+        return (ahead // self.max_workers) * self.generation_seconds()
+
+    def submit(self, query: str, difficulty_level: str = "intermediate",
+               size: str = "1024x1024", references: Optional[List] = None) -> Tuple[Dict, bool]:
+        """
+        Queue a map generation job.
+
+        references can carry reference maps already retrieved for the query (see
+        MapRAG.generate_enhanced_map); they do not affect deduplication.
+
+        Returns:
+            Tuple[Dict, bool]: The job and whether it was newly created
+
+        Raises:
+            QueueFullError: If too many jobs are already active
+            AdmissionRejected: 503 if the job would wait longer than the pending-time budget
+        """
+        request = {"query": query, "difficulty_level": difficulty_level, "size": size}
+        if references is not None:
+            request["references"] = references
+        if self.store.count_active(MAP_JOB_KIND) >= self.max_active:
+            raise QueueFullError("Too many map generations in progress, try again shortly")
+        expected_wait = self.expected_wait()
+        if expected_wait > self.max_wait:
+            raise AdmissionRejected("Map generation is overloaded, try again shortly", 503,
+                                    math.ceil(expected_wait - self.max_wait))
+
+        job, created = self.store.create(MAP_JOB_KIND, request, self.dedup_key(request))
+        if created:
+            self.pool.submit(self._run, job["id"])
+        return job, created
+
+    def recover(self):
+        """
+        Drop old finished jobs, adopt orphaned ones and start the periodic sweep; call once
+        per worker at startup.
+        """
+        self.store.purge(older_than=7 * 24 * 3600)
+        self.sweep()
+        if self._sweeper is None:
+            self._sweeper = threading.Thread(target=self._sweep_loop, name="map-job-sweeper", daemon=True)
+            self._sweeper.start()
+
+    def sweep(self):
+        """Heartbeat this worker's jobs and queue jobs orphaned by workers that died."""
+        self.store.heartbeat()
+        for job_id in self.store.adopt_orphans():
+            print(f"Adopting orphaned map job {job_id}")
+            self.pool.submit(self._run, job_id)
+
+    def _sweep_loop(self):
+        while not self._stop.wait(self.sweep_interval):
+            try:
+                self.sweep()
+            except Exception as e:
+                print(f"Map job sweep failed: {str(e)}")
+
+    def _run(self, job_id: str):
+        """Execute one job if this worker wins the claim, or fail it once its pending budget is spent."""
+        job = self.store.get(job_id)
+        if job is None:
+            return
+        # updated_at of a pending job is when it was queued (or adopted from a dead worker)
+        remaining = self.max_wait - (time.time() - job["updated_at"])
+        if not self.store.claim(job_id):
+            return
+        if remaining <= 0:
+            self.store.fail(job_id, "Map generation waited too long in the queue, try again")
+            return
+        request = job["request"]
+        generate_args = (request["query"],)
+        generate_kwargs = {
+            "difficulty_level": request["difficulty_level"],
+            "size": request["size"],
+            "progress": lambda stage, fraction: self.store.update_progress(job_id, stage, fraction),
+            "references": request.get("references")
+        }
+        try:
+            if self.scheduler is not None:
+                url = self.scheduler.run("map", self._timed_generation, *generate_args,
+                                         priority=BACKGROUND, queue_timeout=remaining, **generate_kwargs)
+            else:
+                url = self._timed_generation(*generate_args, **generate_kwargs)
+            self.store.complete(job_id, {"url": url})
+        except AdmissionRejected:
+            self.store.fail(job_id, "Map generation waited too long in the queue, try again")
+        except Exception as e:
+            print(f"Map job {job_id} failed: {str(e)}")
+            self.store.fail(job_id, str(e))
+
+    def _timed_generation(self, *args, **kwargs) -> str:
+        start = time.monotonic()
+        url = self.map_rag.generate_enhanced_map(*args, **kwargs)
+        self._durations.append(time.monotonic() - start)
+        return url
+
+    def shutdown(self):
+        """Stop accepting work and wait for running jobs."""
+        self._stop.set()
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
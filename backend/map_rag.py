@@ -2,56 +2,82 @@ import os
 import torch
 import numpy as np
 from PIL import Image
-from typing import List, Tuple, Optional, Dict
+from typing import List, Tuple, Optional, Dict, Callable
 from transformers import CLIPProcessor, CLIPModel
 from pathlib import Path
 from dotenv import load_dotenv
 import json
 from pinecone import Pinecone, ServerlessSpec
 from tqdm import tqdm
-from openai import OpenAI
-import base64
+from llm_client import get_llm_client, LLMUnavailableError
 import io
 import re
+from facet_index import FacetIndex
+from map_assets import DerivedImageStore
+from index_snapshots import SnapshotManager, SnapshotWatcher
 
 load_dotenv()
 
+class MapGenerationError(Exception):
+    """Image generation failed."""
+
 class MapRAG:
-    def __init__(self, maps_directory: str = "backend/data/maps"):
+    def __init__(self, maps_directory: Optional[str] = None):
         """
         Initialize the Trail Map RAG system with Pinecone and DALL-E 2.
         
         Args:
-            maps_directory (str): Path to directory containing trail map images
+            maps_directory (str): Path to directory containing trail map images, defaults to
+                data/maps next to this module so it does not depend on the working directory
         """
-        self.maps_directory = Path(maps_directory)
+        self.maps_directory = Path(maps_directory or Path(__file__).resolve().parent / "data" / "maps")
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
         
-        # Initialize OpenAI client
-        self.openai_client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+        # Shared OpenAI client with pooling, timeouts and retries
+        self.openai_client = get_llm_client()
         
         # Initialize CLIP model and processor
         print(f"Loading CLIP model on {self.device}...")
         self.model = CLIPModel.from_pretrained("openai/clip-vit-base-patch32").to(self.device)
         self.processor = CLIPProcessor.from_pretrained("openai/clip-vit-base-patch32")
         
-        # Initialize Pinecone
-        self.pc = Pinecone(
-            api_key=os.getenv('PINECONE_API_KEY'),
-        )
+        # Downscaled variants built at ingest (see map_assets.py)
+        self.assets = DerivedImageStore()
         
         # Constants
         self.INDEX_NAME = "ski-map-embeddings"
         self.EMBEDDING_DIM = 512  # CLIP's embedding dimension
         
-        # Create Pinecone index if it doesn't exist
-        self._initialize_pinecone_index()
-        
-        # Connect to the index
-        self.index = self.pc.Index(self.INDEX_NAME)
+        # Serve from the current versioned map snapshot once one has loaded (hot-swapped when
+        # a new one is activated), else from Pinecone
+        self.snapshot_watcher = SnapshotWatcher(SnapshotManager("maps"))
+        self.pc = None
+        if self.snapshot_watcher.index is None:
+            # Initialize Pinecone
+            self.pc = Pinecone(
+                api_key=os.getenv('PINECONE_API_KEY'),
+            )
+            
+            # Create Pinecone index if it doesn't exist
+            self._initialize_pinecone_index()
+            
+            # Connect to the index
+            self.index = self.pc.Index(self.INDEX_NAME)
         
         # Load metadata if exists
         self.metadata = self._load_metadata()
+        
+        # Facet bitmaps over map metadata for filtered retrieval
+        self.map_paths = list(self.metadata.keys())
+        self.facets = FacetIndex.build(
+            [self.metadata[path] for path in self.map_paths],
+            ["resort", "features", "difficulty_levels"]
+        )
+    
+    def reconnect(self):
+        """Re-open network handles after the process forks (see gunicorn.conf.py)"""
+        if self.pc is not None:
+            self.index = self.pc.Index(self.INDEX_NAME)
     
     def _initialize_pinecone_index(self):
         """Create Pinecone index if it doesn't exist."""
@@ -78,13 +104,52 @@ class MapRAG:
                 return json.load(f)
         return {}
     
-    def query(self, text_query: str, k: int = 3) -> List[Tuple[str, float]]:
+    def build_filters(self, features: Dict[str, List[str]]) -> Dict[str, List[str]]:
+        """
+        Turn features extracted from a query into facet filters over map metadata.
+        
+        Maps without difficulty metadata are kept when filtering by difficulty,
+        since a missing label does not mean the map lacks that terrain.
+        
+        Args:
+            features (Dict[str, List[str]]): Output of extract_features_from_query
+            
+        Returns:
+            Dict[str, List[str]]: Facet filters (empty when the query names no facets)
+        """
+        filters = {}
+        if features.get("resorts"):
+            filters["resort"] = features["resorts"]
+        
+        map_features = []
+        if "double black/expert" in features.get("difficultyLevels", []):
+            map_features.append("expert terrain")
+        if "lake" in features.get("landscapeFeatures", []):
+            map_features.append("lake views")
+        if map_features:
+            filters["features"] = map_features
+        
+        if features.get("difficultyLevels"):
+            filters["difficulty_levels"] = features["difficultyLevels"] + [FacetIndex.MISSING]
+        return filters
+    
+    def _candidate_paths(self, filters: Dict[str, List[str]]) -> Optional[List[str]]:
+        """Resolve facet filters into the map paths that satisfy them (None = no filtering)."""
+        mask = self.facets.mask(filters)
+        if mask is None:
+            return None
+        return [path for path, selected in zip(self.map_paths, mask) if selected]
+    
+    def query(self, text_query: str, k: int = 3,
+              filters: Optional[Dict[str, List[str]]] = None) -> List[Tuple[str, float]]:
         """
         Query the Pinecone index with a text description and return the most similar images.
         
         Args:
             text_query (str): Text description of desired trail map
             k (int): Number of results to return
+            filters (Dict[str, List[str]]): Optional facet filters over resort,
+                features and difficulty_levels; ignored if nothing matches them
             
         Returns:
             List[Tuple[str, float]]: List of (image_path, similarity_score) pairs
@@ -98,11 +163,22 @@ class MapRAG:
             text_features = self.model.get_text_features(**inputs)
             text_embedding = text_features.cpu().numpy()[0]
         
+        self.snapshot_watcher.refresh()
+        if self.snapshot_watcher.index is not None:
+            return self._query_snapshot(text_embedding, k, filters)
+        
+        # Resolve filters to candidate maps before scoring any vectors
+        candidates = self._candidate_paths(filters) if filters else None
+        if candidates is not None and not candidates:
+            print(f"No maps match filters {filters}, searching all maps")
+            candidates = None
+        
         # Query Pinecone
         query_results = self.index.query(
             vector=text_embedding.tolist(),
             top_k=k,
-            include_metadata=True
+            include_metadata=True,
+            filter={"filepath": {"$in": candidates}} if candidates else None
         )
         
         # Format results
@@ -114,6 +190,21 @@ class MapRAG:
         
         return results
     
+    def _query_snapshot(self, text_embedding: np.ndarray, k: int,
+                        filters: Optional[Dict[str, List[str]]]) -> List[Tuple[str, float]]:
+        """Search the current local map snapshot, pre-filtered by its facet bitmaps."""
+        index = self.snapshot_watcher.index
+        
+        mask = index.facets.mask(filters) if filters and index.facets is not None else None
+        if mask is not None and not mask.any():
+            print(f"No maps match filters {filters}, searching all maps")
+            mask = None
+        
+        return [
+            (index.record(row)["metadata"]["filepath"], score)
+            for row, score in index.search(text_embedding, k=k, mask=mask)
+        ]
+    
     def get_metadata(self, image_path: str) -> dict:
         """Get metadata for a specific image."""
         return self.metadata.get(image_path, {})
@@ -132,7 +223,8 @@ class MapRAG:
             "terrainTypes": [],
             "difficultyLevels": [],
             "landscapeFeatures": [],
-            "amenities": []
+            "amenities": [],
+            "resorts": []
         }
         
         # Extract terrain types
@@ -164,18 +256,26 @@ class MapRAG:
             if re.search(r'\b' + pattern, query, re.IGNORECASE):
                 features["amenities"].append(pattern)
         
-        return features
+        # Extract resort names
+        resort_patterns = {
+            r'\bsunshine\b|\bgoat': "sunshine village",
+            r'\blake\s*louise\b': "lake louise",
+            r'\bpalisades\b': "palisades tahoe",
+            r'\balpine\s*meadows\b': "alpine meadows",
+        }
+        for pattern, resort in resort_patterns.items():
+            if re.search(pattern, query, re.IGNORECASE):
+                features["resorts"].append(resort)
         
-    def _image_to_base64(self, image_path: str) -> str:
-        """Convert an image file to base64 encoding."""
-        with open(image_path, "rb") as img_file:
-            return base64.b64encode(img_file.read()).decode('utf-8')
+        return features
         
     def generate_enhanced_map(self, 
                              query: str,
                              difficulty_level: str = "intermediate",
                              size: str = "1024x1024",
-                             num_references: int = 3) -> Dict:
+                             num_references: int = 3,
+                             progress: Optional[Callable[[str, float], None]] = None,
+                             references: Optional[List[Tuple[str, float]]] = None) -> str:
         """
         Generate an enhanced ski trail map based on the query and reference images.
         
@@ -183,16 +283,30 @@ class MapRAG:
             query (str): User text query describing the desired ski map
             difficulty_level (str): Desired difficulty level for the trails
             size (str): Size of the generated image
-            num_references (int): Number of reference images to use
+            num_references (int): Number of similar maps to retrieve
+            progress (Callable[[str, float], None]): Optional callback receiving
+                (stage, fraction complete) as generation advances
+            references (List[Tuple[str, float]]): Reference maps already retrieved for this
+                query (e.g. prefetched while it was typed); skips the vector query
             
         Returns:
-            Dict: Generation results including the generated image
+            str: URL of the generated image
+            
+        Raises:
+            MapGenerationError: If the image could not be generated
         """
+        if progress is None:
+            progress = lambda stage, fraction: None
+        
         # Step 1: Extract features from the query to enhance DALL-E prompt
+        progress("retrieving", 0.1)
         features = self.extract_features_from_query(query)
         
-        # Step 2: Retrieve similar maps using RAG
-        similar_maps = self.query(query, k=num_references)
+        # Step 2: Retrieve similar maps using RAG, narrowed by the extracted features
+        if references is not None:
+            similar_maps = [tuple(reference) for reference in references[:num_references]]
+        else:
+            similar_maps = self.query(query, k=num_references, filters=self.build_filters(features))
         
         # Step 3: Create an enhanced prompt for DALL-E
         difficulty_colors = {
@@ -244,35 +358,13 @@ class MapRAG:
         - green for beginner, blue for intermediate, black for advanced, double black for expert
         """
         
-        # Step 4: Prepare reference images if available
-        reference_images = []
-        if similar_maps:
-            print(f"Using {len(similar_maps)} reference images for generation")
-            for path, score in similar_maps:
-                try:
-                    # Add reference image
-                    image_path = path
-                    if not os.path.exists(image_path):
-                        # Try to find the image using the filename if the path isn't correct
-                        filename = os.path.basename(path)
-                        possible_path = os.path.join(self.maps_directory, filename)
-                        if os.path.exists(possible_path):
-                            image_path = possible_path
-                        else:
-                            print(f"Warning: Reference image not found: {path}")
-                            continue
-                    
-                    # Create image for reference
-                    reference_images.append({
-                        "image": self._image_to_base64(image_path),
-                        "weight": min(1.0, 0.5 + score / 2)  # Convert score to a weight between 0.5 and 1.0
-                    })
-                except Exception as e:
-                    print(f"Error processing reference image {path}: {str(e)}")
-        
-        # Step 5: Generate new image with DALL-E
+        # DALL-E 3 takes a text prompt only, so the retrieved maps are not sent along
+        print(f"Retrieved {len(similar_maps)} similar maps for the query")
+        
+        # Step 4: Generate new image with DALL-E
+        progress("generating", 0.3)
         try:
-            response = self.openai_client.images.generate(
+            response = self.openai_client.generate_image(
                 model="dall-e-3",  # Using DALL-E 3 for better quality
                 prompt=prompt,
                 size=size,
@@ -280,12 +372,14 @@ class MapRAG:
                 n=1,
             )
             
-            # Step 6: Return the results
+            # Step 5: Return the results
             return response.data[0].url
             
+        except LLMUnavailableError:
+            raise
         except Exception as e:
             print(f"Error generating image: {str(e)}")
-            return str(e)
+            raise MapGenerationError(f"Image generation failed: {str(e)}") from e
     
     def analyze_map_style(self, image_path: str) -> List[str]:
         """
@@ -327,5 +421,4 @@ if __name__ == "__main__":
         query="Generate a ski trail map with steep descents and alpine terrain for expert skiers",
         difficulty_level="expert"
     )
-    print("\nGenerated map URL:", result["generated_image_url"])
-    print("\nPrompt used:", result["prompt"])
+    print("\nGenerated map URL:", result)
@@ -0,0 +1,144 @@
+import os
+import re
+from typing import Dict, List
+
+# Words that signal reasoning, comparison or multi-step answers
+COMPLEX_PATTERNS = [
+    r"\bwhy\b", r"\bhow (do|does|can|should|would|to)\b", r"\bcompare\b", r"\bdifferen(ce|t)\b",
+    r"\bversus\b", r"\bvs\.?\b", r"\bexplain\b", r"\bshould i\b", r"\bbest\b", r"\brecommend",
+    r"\bplan\b", r"\bsteps?\b", r"\bimprove\b", r"\bpros and cons\b", r"\btrade-?offs?\b",
+]
+
+# Short lookups that a retrieved passage usually answers verbatim
+DEFINITIONAL_PATTERNS = [
+    r"^(what|who) (is|are|was|were) (a |an |the )?[\w\s-]{1,40}\??$",
+    r"^define\b", r"^what does [\w\s-]{1,40} mean\??$", r"^when (was|did)\b", r"^where is\b",
+]
+
+STOPWORDS = {
+    "a", "an", "the", "is", "are", "was", "were", "what", "who", "when", "where", "does", "do",
+    "of", "in", "on", "for", "to", "and", "or", "mean", "define", "how", "it", "its", "i",
+}
+
+
+class ModelRouter:
+    """
+    Picks how to answer an encyclopedia query from its complexity and retrieval confidence.
+
+    Routes:
+        extractive: answer with the best-matching sentences of the top chunk, no LLM call
+        fast: a smaller, cheaper model for simple queries with a confident retrieval
+        large: the full model for everything else
+    """
+
+    def __init__(self,
+                 fast_model: str = "gpt-4o-mini",
+                 large_model: str = "chatgpt-4o-latest",
+                 max_fast_complexity: float = 0.4,
+                 min_fast_confidence: float = 0.5,
+                 enable_extractive: bool = False,
+                 min_extractive_confidence: float = 0.7):
+        self.fast_model = fast_model
+        self.large_model = large_model
+        self.max_fast_complexity = max_fast_complexity
+        self.min_fast_confidence = min_fast_confidence
+        self.enable_extractive = enable_extractive
+        self.min_extractive_confidence = min_extractive_confidence
+
+    @classmethod
+    def from_env(cls, large_model: str = "chatgpt-4o-latest") -> "ModelRouter":
+        """Build a router configured from ROUTER_* environment variables."""
+        return cls(
+            fast_model=os.getenv("ROUTER_FAST_MODEL", "gpt-4o-mini"),
+            large_model=os.getenv("ROUTER_LARGE_MODEL", large_model),
+            max_fast_complexity=float(os.getenv("ROUTER_MAX_FAST_COMPLEXITY", "0.4")),
+            min_fast_confidence=float(os.getenv("ROUTER_MIN_FAST_CONFIDENCE", "0.5")),
+            enable_extractive=os.getenv("ROUTER_EXTRACTIVE", "0") == "1",
+            min_extractive_confidence=float(os.getenv("ROUTER_MIN_EXTRACTIVE_CONFIDENCE", "0.7")),
+        )
+
+    @staticmethod
+    def is_definitional(query: str) -> bool:
+        """Whether the query is a short "what is X" style lookup."""
+        normalized = query.strip().lower()
+        return any(re.search(pattern, normalized) for pattern in DEFINITIONAL_PATTERNS)
+
+    def complexity(self, query: str) -> float:
+        """Heuristic complexity score in [0, 1]."""
+        normalized = query.strip().lower()
+        words = normalized.split()
+
+        score = min(len(words) / 40.0, 0.4)
+        score += 0.2 * min(sum(bool(re.search(p, normalized)) for p in COMPLEX_PATTERNS), 3)
+        if normalized.count("?") > 1:
+            score += 0.2
+        if self.is_definitional(normalized):
+            score -= 0.3
+        return max(0.0, min(1.0, score))
+
+    @staticmethod
+    def confidence(matches: List[Dict]) -> Dict[str, float]:
+        """Retrieval confidence from the similarity scores of the ranked matches."""
+        scores = [match["score"] for match in matches]
+        top = scores[0] if scores else 0.0
+        margin = top - scores[1] if len(scores) > 1 else top
+        return {"top_score": top, "margin": margin}
+
+    def extract_answer(self, query: str, matches: List[Dict], max_sentences: int = 2) -> str:
+        """Pick the sentences of the top chunk that share the most terms with the query."""
+        if not matches:
+            return ""
+        terms = {w for w in re.findall(r"[a-z0-9-]+", query.lower()) if w not in STOPWORDS}
+        if not terms:
+            return ""
+
+        sentences = re.split(r"(?<=[.!?])\s+", matches[0]["text"].strip())
+        scored = []
+        for position, sentence in enumerate(sentences):
+            overlap = len(terms & set(re.findall(r"[a-z0-9-]+", sentence.lower())))
+            if overlap:
+                scored.append((overlap, position, sentence))
+        if not scored:
+            return ""
+
+        best = sorted(scored, key=lambda item: (-item[0], item[1]))[:max_sentences]
+        return " ".join(sentence for _, _, sentence in sorted(best, key=lambda item: item[1]))
+
+    def route(self, query: str, matches: List[Dict]) -> Dict:
+        """
+        Decide how to answer a query.
+
+        Args:
+            query (str): User query
+            matches (List[Dict]): Scored chunks from EncyclopediaRAG.retrieve_scored_chunks
+
+        Returns:
+            Dict: {"route", "model", "complexity", "top_score", "margin", "reason"} and,
+                for the extractive route, "answer"
+        """
+        complexity = self.complexity(query)
+        confidence = self.confidence(matches)
+        decision = {"complexity": round(complexity, 3), **{k: round(v, 3) for k, v in confidence.items()}}
+
+        if (self.enable_extractive and self.is_definitional(query)
+                and confidence["top_score"] >= self.min_extractive_confidence):
+            answer = self.extract_answer(query, matches)
+            if answer:
+                decision.update(route="extractive", model=None, answer=answer,
+                                reason="definitional query with a high-confidence match")
+                return self._log(query, decision)
+
+        if complexity <= self.max_fast_complexity and confidence["top_score"] >= self.min_fast_confidence:
+            decision.update(route="fast", model=self.fast_model, reason="simple query with a confident retrieval")
+        elif complexity > self.max_fast_complexity:
+            decision.update(route="large", model=self.large_model, reason="complex query")
+        else:
+            decision.update(route="large", model=self.large_model, reason="low retrieval confidence")
+        return self._log(query, decision)
+
+    @staticmethod
+    def _log(query: str, decision: Dict) -> Dict:
+        print(f"Routing query to {decision['route']} ({decision['model']}): {decision['reason']}, "
+              f"complexity={decision['complexity']} top_score={decision['top_score']} "
+              f"margin={decision['margin']} query={query[:80]!r}")
+        return decision
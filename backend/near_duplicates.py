@@ -0,0 +1,147 @@
+import re
+import zlib
+from typing import Dict, List, Optional
+
+import numpy as np
+
+_TOKEN_PATTERN = re.compile(r"\w+")
+_SHINGLE_MULTIPLIER = np.uint64(0x100000001B3)
+
+
+class NearDuplicateFilter:
+    """
+    Streaming near-duplicate detection for text chunks with MinHash and LSH.
+
+    Every chunk is reduced to a MinHash signature over its word shingles, which estimates
+    the Jaccard similarity of two chunks as the fraction of equal signature entries. The
+    signature is split into bands; chunks that agree on a whole band become candidates and
+    are compared on the full signature. Only kept chunks are inserted, so memory grows with
+    the number of unique chunks and documents can be checked as they arrive.
+
+    Signatures for a batch of chunks are computed together: all shingle hashes are permuted
+    with one matrix operation and reduced per chunk with `np.minimum.reduceat`.
+    """
+
+    def __init__(self, threshold: float = 0.8, num_perm: int = 128, bands: int = 16,
+                 shingle_size: int = 5, seed: int = 0):
+        """
+        Args:
+            threshold (float): Estimated Jaccard similarity above which a chunk is a duplicate
+            num_perm (int): MinHash signature length
+            bands (int): LSH bands; num_perm must be divisible by it. With 16 bands of 8 rows,
+                pairs above ~0.7 similarity almost always become candidates
+            shingle_size (int): Words per shingle
+            seed (int): Seed for the hash permutations
+        """
+        if num_perm % bands:
+            raise ValueError("num_perm must be divisible by bands")
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+
+        # Multiply-shift hash family: h(x) = (a * x + b) >> 32 with odd a, wrapping in uint64
+        rng = np.random.default_rng(seed)
+        self._a = rng.integers(1, 2 ** 63, size=(num_perm, 1), dtype=np.uint64) | np.uint64(1)
+        self._b = rng.integers(0, 2 ** 63, size=(num_perm, 1), dtype=np.uint64)
+
+        self._buckets: List[Dict[bytes, List[int]]] = [{} for _ in range(bands)]
+        self._signatures = np.zeros((1024, num_perm), dtype=np.uint32)
+        self.kept = 0
+        self.seen = 0
+
+    def _shingles(self, text: str) -> np.ndarray:
+        """Hashes of the word n-grams of a text."""
+        words = np.array(
+            [zlib.crc32(token.encode("utf-8")) for token in _TOKEN_PATTERN.findall(text.lower())],
+            dtype=np.uint64,
+        )
+        if len(words) == 0:
+            return np.zeros(1, dtype=np.uint64)
+        size = min(self.shingle_size, len(words))
+        count = len(words) - size + 1
+        hashes = np.zeros(count, dtype=np.uint64)
+        for offset in range(size):
+            hashes = hashes * _SHINGLE_MULTIPLIER + words[offset:offset + count]
+        return np.unique(hashes)
+
+    def signatures(self, texts: List[str], block_size: int = 65536) -> np.ndarray:
+        """
+        MinHash signatures of a batch of texts.
+
+        Returns:
+            np.ndarray: (len(texts), num_perm) uint32 signatures
+        """
+        shingles = [self._shingles(text) for text in texts]
+        signatures = np.zeros((len(texts), self.num_perm), dtype=np.uint32)
+
+        # Process the batch in blocks of shingles to bound the (num_perm, shingles) matrix
+        start = 0
+        while start < len(texts):
+            end, total = start, 0
+            while end < len(texts) and (end == start or total + len(shingles[end]) <= block_size):
+                total += len(shingles[end])
+                end += 1
+            block = np.concatenate(shingles[start:end])
+            offsets = np.cumsum([0] + [len(s) for s in shingles[start:end - 1]])
+            permuted = ((self._a * block[None, :] + self._b) >> np.uint64(32)).astype(np.uint32)
+            signatures[start:end] = np.minimum.reduceat(permuted, offsets, axis=1).T
+            start = end
+        return signatures
+
+    def _band_keys(self, signature: np.ndarray) -> List[bytes]:
+        return [signature[i * self.rows:(i + 1) * self.rows].tobytes() for i in range(self.bands)]
+
+    def _find(self, signature: np.ndarray, keys: List[bytes]) -> Optional[int]:
+        """The kept chunk this signature duplicates, if any."""
+        candidates = set()
+        for band, key in enumerate(keys):
+            candidates.update(self._buckets[band].get(key, ()))
+        if not candidates:
+            return None
+        candidates = np.fromiter(candidates, dtype=np.int64)
+        similarity = (self._signatures[candidates] == signature).mean(axis=1)
+        best = int(np.argmax(similarity))
+        return int(candidates[best]) if similarity[best] >= self.threshold else None
+
+    def _insert(self, signature: np.ndarray, keys: List[bytes]) -> int:
+        if self.kept == len(self._signatures):
+            self._signatures = np.concatenate([self._signatures, np.zeros_like(self._signatures)])
+        position = self.kept
+        self._signatures[position] = signature
+        for band, key in enumerate(keys):
+            self._buckets[band].setdefault(key, []).append(position)
+        self.kept += 1
+        return position
+
+    def check(self, texts: List[str]) -> List[Optional[int]]:
+        """
+        Check a batch of chunks against everything kept so far, including earlier ones in the batch.
+
+        Returns:
+            List[Optional[int]]: For each text, None if it was kept (and is now indexed), or the
+                position, in keep order, of the kept chunk it duplicates
+        """
+        results = []
+        for signature in self.signatures(texts):
+            keys = self._band_keys(signature)
+            duplicate_of = self._find(signature, keys)
+            if duplicate_of is None:
+                self._insert(signature, keys)
+            results.append(duplicate_of)
+        self.seen += len(texts)
+        return results
+
+    @property
+    def dropped(self) -> int:
+        return self.seen - self.kept
+
+    @property
+    def dedup_ratio(self) -> float:
+        """Fraction of checked chunks that were duplicates."""
+        return self.dropped / self.seen if self.seen else 0.0
+
+    def report(self) -> str:
+        return (f"Near-duplicate filter: kept {self.kept} of {self.seen} chunks, "
+                f"removed {self.dropped} ({self.dedup_ratio:.1%})")
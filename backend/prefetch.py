@@ -0,0 +1,270 @@
+import difflib
+import json
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+from query_log import normalize_query
+from shared_cache import SharedCache
+
+PREFETCH_MODES = ("encyclopedia", "map")
+
+
+class PrefetchRateLimited(Exception):
+    """A session or client sent prefetches faster than allowed."""
+
+
+class TokenBucket:
+    """Allows `rate` events per second on average and bursts of up to `burst`; not thread-safe."""
+
+    def __init__(self, rate: float, burst: float, now: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def refill(self, now: float) -> float:
+        """Add the tokens accrued since the last call; returns the tokens available."""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return self.tokens
+
+
+class PrefetchManager:
+    """
+    Speculative retrieval for text the user is still typing.
+
+    The client posts its debounced draft; retrieval (embedding + vector search, or the CLIP
+    map query) runs on a small background pool and the result is kept per session for a
+    short time in the SharedCache, so whichever worker receives the final request can use it.
+    When the submitted text is close enough to a prefetched draft, the vector query is
+    skipped entirely.
+
+    Prefetching is strictly best effort: drafts that are too short, too frequent, or arrive
+    while the matching scheduler lane is busy are skipped, and a newer draft from the same
+    session supersedes an older one that has not finished yet. Session IDs are chosen by the
+    client, so besides the per-session limits every client address and the worker as a whole
+    have a token bucket.
+    """
+
+    def __init__(self, encyclopedia_rag, map_rag, scheduler=None):
+        """
+        Args:
+            encyclopedia_rag (EncyclopediaRAG): Engine used for encyclopedia prefetches
+            map_rag (MapRAG): Engine used for map prefetches
+            scheduler (WorkloadScheduler): Optional; prefetching pauses while a lane is busy
+
+        Configured with PREFETCH_TTL (seconds a result is kept, default 60), PREFETCH_MIN_CHARS
+        (default 12), PREFETCH_MIN_INTERVAL (seconds between a session's prefetches, default
+        0.3, below the client's 400 ms debounce), PREFETCH_PER_MINUTE (per session, default 30),
+        PREFETCH_CLIENT_RATE and PREFETCH_CLIENT_BURST (per client address, default 2/s with
+        bursts of 20), PREFETCH_GLOBAL_RATE (per worker, default 20/s with bursts of twice
+        that), PREFETCH_MAX_PENDING (default 8), PREFETCH_WORKERS (default 2) and
+        PREFETCH_REUSE_SIMILARITY (default 0.9).
+        """
+        self.encyclopedia_rag = encyclopedia_rag
+        self.map_rag = map_rag
+        self.scheduler = scheduler
+        self.ttl = float(os.getenv("PREFETCH_TTL", "60"))
+        self.min_chars = int(os.getenv("PREFETCH_MIN_CHARS", "12"))
+        self.min_interval = float(os.getenv("PREFETCH_MIN_INTERVAL", "0.3"))
+        self.per_minute = int(os.getenv("PREFETCH_PER_MINUTE", "30"))
+        self.client_rate = float(os.getenv("PREFETCH_CLIENT_RATE", "2"))
+        self.client_burst = float(os.getenv("PREFETCH_CLIENT_BURST", "20"))
+        global_rate = float(os.getenv("PREFETCH_GLOBAL_RATE", "20"))
+        self.max_pending = int(os.getenv("PREFETCH_MAX_PENDING", "8"))
+        self.max_workers = int(os.getenv("PREFETCH_WORKERS", "2"))
+        self.reuse_similarity = float(os.getenv("PREFETCH_REUSE_SIMILARITY", "0.9"))
+        self.store = SharedCache(namespace="prefetch:")
+
+        # Reentrant: cancelling a future runs its done-callback, which takes the lock again
+        self._lock = threading.RLock()
+        self._pool = None
+        self._latest: Dict[str, int] = {}
+        self._futures = {}
+        self._history: Dict[str, deque] = {}
+        self._clients: Dict[str, TokenBucket] = {}
+        self._global = TokenBucket(global_rate, 2 * global_rate, time.monotonic())
+
+        # Metrics
+        self.stats_counts = {"scheduled": 0, "skipped": 0, "rate_limited": 0,
+                             "superseded": 0, "hits": 0, "misses": 0}
+
+    @property
+    def pool(self) -> ThreadPoolExecutor:
+        # Created on first use so no threads exist before gunicorn forks the workers
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="prefetch")
+        return self._pool
+
+    @staticmethod
+    def _key(session_id: str, mode: str) -> str:
+        return f"{session_id}:{mode}"
+
+    def _count(self, name: str):
+        with self._lock:
+            self.stats_counts[name] += 1
+
+    def _forget_quiet(self, now: float):
+        """Drop the state of sessions quiet for a minute and of clients with a full bucket."""
+        self._history = {k: h for k, h in self._history.items() if h and now - h[-1] < 60}
+        self._latest = {k: seq for k, seq in self._latest.items() if k in self._history}
+        self._clients = {c: b for c, b in self._clients.items() if b.refill(now) < b.burst}
+
+    def _check_rate(self, key: str, client: Optional[str], now: float):
+        """
+        Enforce the per-session minimum interval and per-minute cap, then the client and
+        worker token buckets; call with the lock held.
+        """
+        if len(self._history) >= 10000 or len(self._clients) >= 10000:
+            self._forget_quiet(now)
+
+        history = self._history.get(key)
+        if history is None:
+            history = self._history[key] = deque(maxlen=self.per_minute)
+        if history and now - history[-1] < self.min_interval:
+            raise PrefetchRateLimited("Prefetching too often")
+        if len(history) == self.per_minute and now - history[0] < 60:
+            raise PrefetchRateLimited("Prefetch limit reached for this minute")
+
+        bucket = None
+        if client is not None:
+            bucket = self._clients.get(client)
+            if bucket is None:
+                bucket = self._clients[client] = TokenBucket(self.client_rate, self.client_burst, now)
+            if bucket.refill(now) < 1:
+                raise PrefetchRateLimited("Prefetching too often from this client")
+        if self._global.refill(now) < 1:
+            raise PrefetchRateLimited("Too many prefetches on this server")
+
+        if bucket is not None:
+            bucket.tokens -= 1
+        self._global.tokens -= 1
+        history.append(now)
+
+    def submit(self, session_id: str, mode: str, text: str, seq: int,
+               filters: Optional[Dict[str, List[str]]] = None, client: Optional[str] = None) -> Dict:
+        """
+        Schedule retrieval for a draft, superseding the session's previous draft.
+
+        Args:
+            session_id (str): Client-generated prefetch session ID
+            mode (str): "encyclopedia" or "map"
+            text (str): Draft text
+            seq (int): Client sequence number; higher numbers are newer drafts
+            filters (Dict): Encyclopedia retrieval filters the final request will use
+            client (str): Client address, for the per-client rate limit
+
+        Returns:
+            Dict: {"status": "scheduled"} or {"status": "skipped", "reason": ...}
+
+        Raises:
+            PrefetchRateLimited: If the session, client or worker exceeded its rate limit
+        """
+        if mode not in PREFETCH_MODES:
+            raise ValueError(f"Invalid model type {mode}")
+        if len(text.strip()) < self.min_chars:
+            self._count("skipped")
+            return {"status": "skipped", "reason": "too short"}
+        if self.scheduler is not None and self.scheduler.busy(mode):
+            self._count("skipped")
+            return {"status": "skipped", "reason": "busy"}
+
+        key = self._key(session_id, mode)
+        with self._lock:
+            if seq <= self._latest.get(key, -1):
+                self.stats_counts["skipped"] += 1
+                return {"status": "skipped", "reason": "stale"}
+            try:
+                self._check_rate(key, client, time.monotonic())
+            except PrefetchRateLimited:
+                self.stats_counts["rate_limited"] += 1
+                raise
+
+            # Drop the previous draft if it has not started; a running one stops at its next check
+            previous = self._futures.pop(key, None)
+            if previous is not None and previous.cancel():
+                self.stats_counts["superseded"] += 1
+            if len(self._futures) >= self.max_pending:
+                self.stats_counts["skipped"] += 1
+                return {"status": "skipped", "reason": "busy"}
+
+            self._latest[key] = seq
+            future = self._futures[key] = self.pool.submit(self._run, key, mode, text, seq, filters)
+            self.stats_counts["scheduled"] += 1
+        future.add_done_callback(lambda done: self._forget(key, done))
+        return {"status": "scheduled"}
+
+    def _forget(self, key: str, future):
+        with self._lock:
+            if self._futures.get(key) is future:
+                del self._futures[key]
+
+    def _superseded(self, key: str, seq: int) -> bool:
+        with self._lock:
+            if self._latest.get(key) != seq:
+                self.stats_counts["superseded"] += 1
+                return True
+            return False
+
+    def _run(self, key: str, mode: str, text: str, seq: int, filters: Optional[Dict]):
+        """Retrieve for a draft and store the result unless a newer draft arrived meanwhile."""
+        try:
+            if self._superseded(key, seq):
+                return
+            if mode == "encyclopedia":
+                result = {
+                    "embedding": self.encyclopedia_rag._embed_query(text),
+                    "matches": self.encyclopedia_rag.retrieve_scored_chunks(text, filters=filters),
+                }
+            else:
+                features = self.map_rag.extract_features_from_query(text)
+                references = self.map_rag.query(text, k=3, filters=self.map_rag.build_filters(features))
+                result = {"references": [(path, float(score)) for path, score in references]}
+            if self._superseded(key, seq):
+                return
+
+            # Another worker may have stored a newer draft for this session
+            current = self.store.get(key)
+            if current is not None and json.loads(current)["seq"] > seq:
+                return
+            entry = {"seq": seq, "text": normalize_query(text), "filters": filters, **result}
+            self.store.set(key, json.dumps(entry).encode("utf-8"), ttl=self.ttl)
+        except Exception as e:
+            print(f"Prefetch failed for {mode} draft: {str(e)}")
+
+    def take(self, session_id: Optional[str], mode: str, text: str,
+             filters: Optional[Dict[str, List[str]]] = None) -> Optional[Dict]:
+        """
+        Prefetched retrieval for a submitted message, if a close enough draft was prefetched.
+
+        Returns:
+            Optional[Dict]: {"matches", "embedding"} for encyclopedia or {"references"} for map,
+                or None on a miss
+        """
+        if not session_id:
+            return None
+        raw = self.store.get(self._key(session_id, mode))
+        if raw is None:
+            self._count("misses")
+            return None
+        entry = json.loads(raw)
+
+        similarity = difflib.SequenceMatcher(None, entry["text"], normalize_query(text)).ratio()
+        if entry["filters"] != filters or similarity < self.reuse_similarity:
+            self._count("misses")
+            return None
+        self._count("hits")
+        print(f"Reusing prefetched {mode} retrieval (similarity={similarity:.3f})")
+        return entry
+
+    def stats(self) -> Dict:
+        with self._lock:
+            counts = dict(self.stats_counts)
+            counts["pending"] = len(self._futures)
+        lookups = counts["hits"] + counts["misses"]
+        counts["hit_rate"] = round(counts["hits"] / lookups, 3) if lookups else 0.0
+        return counts
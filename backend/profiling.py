@@ -0,0 +1,235 @@
+import cProfile
+import io
+import itertools
+import os
+import pstats
+import random
+import sys
+import threading
+import time
+import tracemalloc
+from collections import OrderedDict, deque
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+
+
+def rss_bytes() -> Optional[int]:
+    """Resident set size of this process, from /proc where available."""
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def approx_size(obj, sample: int = 100) -> int:
+    """
+    Approximate deep size in bytes of a cache value: numpy arrays, strings, and lists/dicts of them.
+
+    Containers larger than `sample` are estimated from their first `sample` items.
+    """
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if isinstance(obj, (str, bytes, int, float, type(None))):
+        return sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        items = list(obj.items())
+        sampled = items[:sample]
+        per_item = sum(approx_size(k) + approx_size(v) for k, v in sampled) / max(1, len(sampled))
+        return sys.getsizeof(obj) + int(per_item * len(items))
+    if isinstance(obj, (list, tuple, set, deque)):
+        items = list(obj)
+        sampled = items[:sample]
+        per_item = sum(approx_size(v) for v in sampled) / max(1, len(sampled))
+        return sys.getsizeof(obj) + int(per_item * len(items))
+    return sys.getsizeof(obj)
+
+
+def model_size(model) -> Dict:
+    """Parameter and buffer count and bytes of a torch module."""
+    tensors = list(model.parameters()) + list(model.buffers())
+    return {
+        "parameters": sum(t.numel() for t in tensors),
+        "bytes": sum(t.numel() * t.element_size() for t in tensors),
+        "dtype": str(tensors[0].dtype) if tensors else None,
+        "device": str(tensors[0].device) if tensors else None,
+    }
+
+
+class Profiler:
+    """
+    On-demand diagnostics for a running worker.
+
+    Request profiling is armed for a number of requests; `wrap` returns the function itself
+    while nothing is armed, so the request path pays for one attribute read. Captures are
+    written as .prof files (readable with pstats or snakeviz) and tracemalloc snapshots as
+    .tracemalloc files, both under PROFILE_DIR (default data/profiles). State is per worker
+    process.
+    """
+
+    def __init__(self, dump_dir: Optional[str] = None, keep: int = 50):
+        """
+        Args:
+            dump_dir (str): Where dumps are written, defaults to PROFILE_DIR or data/profiles
+            keep (int): Number of recent captures kept in the summary list
+        """
+        self.dump_dir = Path(dump_dir or os.getenv("PROFILE_DIR", "data/profiles"))
+        self.remaining = 0
+        self.sample_rate = 1.0
+        self.captures = deque(maxlen=keep)
+        self._lock = threading.Lock()
+        # Only one cProfile profiler can be active in a process at a time
+        self._profile_lock = threading.Lock()
+        self._last_snapshot = None
+        self._dump_seq = itertools.count()
+
+    def start(self, requests: int, sample_rate: float = 1.0):
+        """Profile the next `requests` sampled requests, each request sampled with `sample_rate`."""
+        with self._lock:
+            self.remaining = requests
+            self.sample_rate = sample_rate
+        print(f"Profiling armed for {requests} requests (sample rate {sample_rate}) in worker {os.getpid()}")
+
+    def stop(self):
+        with self._lock:
+            self.remaining = 0
+
+    def wrap(self, label: str, fn: Callable) -> Callable:
+        """Return `fn`, or while profiling is armed, a wrapper that may profile one call of it."""
+        if not self.remaining:
+            return fn
+
+        def profiled(*args, **kwargs):
+            if random.random() >= self.sample_rate or not self._profile_lock.acquire(blocking=False):
+                return fn(*args, **kwargs)
+            try:
+                with self._lock:
+                    armed = self.remaining > 0
+                    if armed:
+                        self.remaining -= 1
+                if not armed:
+                    return fn(*args, **kwargs)
+                profile = cProfile.Profile()
+                start = time.perf_counter()
+                try:
+                    return profile.runcall(fn, *args, **kwargs)
+                finally:
+                    self._save_profile(label, profile, time.perf_counter() - start)
+            finally:
+                self._profile_lock.release()
+
+        return profiled
+
+    def _save_profile(self, label: str, profile: cProfile.Profile, elapsed: float):
+        self.dump_dir.mkdir(parents=True, exist_ok=True)
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{next(self._dump_seq)}-{label}.prof"
+        profile.dump_stats(self.dump_dir / name)
+
+        summary = io.StringIO()
+        pstats.Stats(profile, stream=summary).sort_stats("cumulative").print_stats(15)
+        self.captures.append({
+            "file": name,
+            "label": label,
+            "elapsed_ms": round(elapsed * 1000, 1),
+            "created_at": time.time(),
+            "top": summary.getvalue(),
+        })
+        print(f"Saved request profile {name} ({elapsed * 1000:.0f} ms)")
+
+    def start_tracemalloc(self, frames: int = 25):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+            self._last_snapshot = None
+
+    def stop_tracemalloc(self):
+        tracemalloc.stop()
+        self._last_snapshot = None
+
+    def snapshot(self, top: int = 30) -> Dict:
+        """
+        Take a tracemalloc snapshot, write it to a file and compare it with the previous one.
+
+        Returns:
+            Dict: The dump file name, traced memory and the top allocation sites (or growth
+                since the previous snapshot)
+
+        Raises:
+            RuntimeError: If tracemalloc is not tracing
+        """
+        if not tracemalloc.is_tracing():
+            raise RuntimeError("tracemalloc is not running")
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ])
+        self.dump_dir.mkdir(parents=True, exist_ok=True)
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{next(self._dump_seq)}.tracemalloc"
+        snapshot.dump(str(self.dump_dir / name))
+
+        if self._last_snapshot is not None:
+            stats = snapshot.compare_to(self._last_snapshot, "lineno")[:top]
+            kind = "diff"
+        else:
+            stats = snapshot.statistics("lineno")[:top]
+            kind = "top"
+        self._last_snapshot = snapshot
+
+        current, peak = tracemalloc.get_traced_memory()
+        return {
+            "file": name,
+            "kind": kind,
+            "traced_bytes": current,
+            "peak_traced_bytes": peak,
+            "stats": [str(stat) for stat in stats],
+        }
+
+    def dump_path(self, name: str) -> Optional[Path]:
+        """Path of a dump file by name, refusing anything outside the dump directory."""
+        path = self.dump_dir / name
+        if path.name != name or not path.is_file():
+            return None
+        return path
+
+    def list_dumps(self) -> List[Dict]:
+        if not self.dump_dir.exists():
+            return []
+        return [
+            {"file": path.name, "bytes": path.stat().st_size, "modified_at": path.stat().st_mtime}
+            for path in sorted(self.dump_dir.iterdir()) if path.suffix in (".prof", ".tracemalloc")
+        ]
+
+    @staticmethod
+    def memory_report(caches: Dict[str, object], models: Dict[str, object]) -> Dict:
+        """
+        Process memory, in-process cache sizes, model sizes and torch thread settings.
+
+        Args:
+            caches (Dict[str, object]): Name -> cache (dict-like or anything with len())
+            models (Dict[str, object]): Name -> torch module
+        """
+        import torch
+
+        cache_report = {}
+        for name, cache in caches.items():
+            entry = {"entries": len(cache)}
+            if isinstance(cache, (dict, OrderedDict)):
+                entry["approx_bytes"] = approx_size(cache)
+            cache_report[name] = entry
+
+        return {
+            "pid": os.getpid(),
+            "rss_bytes": rss_bytes(),
+            "caches": cache_report,
+            "models": {name: model_size(model) for name, model in models.items()},
+            "torch": {
+                "num_threads": torch.get_num_threads(),
+                "num_interop_threads": torch.get_num_interop_threads(),
+                "cuda_available": torch.cuda.is_available(),
+            },
+            "tracemalloc": tracemalloc.is_tracing(),
+        }
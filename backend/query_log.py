@@ -0,0 +1,64 @@
+import json
+import os
+import re
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional
+
+
+def normalize_query(query: str) -> str:
+    """Canonical form used to group repeated questions: lowercase, no punctuation, single spaces."""
+    query = re.sub(r"[^\w\s-]", " ", query.lower())
+    return re.sub(r"\s+", " ", query).strip()
+
+
+class QueryLog:
+    """
+    Append-only JSON-lines log of encyclopedia queries.
+
+    Each line records the normalized query, end-to-end latency, the retrieved chunk IDs and
+    the index version that served it. The log feeds the offline cache-warming job
+    (warm_cache.py). Lines are written with a single append so concurrent workers don't
+    interleave them.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = Path(path or os.getenv("QUERY_LOG_PATH", "data/logs/queries.jsonl"))
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.enabled = os.getenv("QUERY_LOG_ENABLED", "1") == "1"
+        self._lock = threading.Lock()
+
+    def record(self, query: str, latency_ms: float, chunk_ids: List[str],
+               index_version: str, route: Optional[str] = None):
+        """Append one query to the log; failures are logged and ignored."""
+        if not self.enabled:
+            return
+        entry = {
+            "ts": time.time(),
+            "query": query,
+            "normalized": normalize_query(query),
+            "latency_ms": round(latency_ms, 1),
+            "chunk_ids": chunk_ids,
+            "index_version": index_version,
+            "route": route,
+        }
+        line = json.dumps(entry, ensure_ascii=False) + "\n"
+        try:
+            with self._lock, open(self.path, "a", encoding="utf-8") as f:
+                f.write(line)
+        except OSError as e:
+            print(f"Could not write query log: {str(e)}")
+
+    def read(self, since: Optional[float] = None) -> Iterator[Dict]:
+        """Iterate over logged entries, optionally only those newer than `since`."""
+        if not self.path.exists():
+            return
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if since is None or entry.get("ts", 0) >= since:
+                    yield entry
@@ -0,0 +1,191 @@
+import heapq
+import itertools
+import os
+import threading
+import time
+from collections import deque
+from typing import Callable, Dict, Optional
+
+INTERACTIVE = 0
+BACKGROUND = 1
+
+
+class AdmissionRejected(Exception):
+    """A request was shed instead of queued: the lane is full or the queue-time budget ran out."""
+
+    def __init__(self, message: str, status_code: int, retry_after: int):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class Lane:
+    """
+    A concurrency pool with a bounded priority queue in front of it.
+
+    Waiters are served lowest priority value first, then first come first served. A freed
+    slot is handed directly to the next waiter so later arrivals cannot overtake it.
+    """
+
+    def __init__(self, name: str, max_concurrency: int, max_queue: int, queue_timeout: float):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+
+        self._cond = threading.Condition()
+        self._active = 0
+        self._waiters = []
+        self._seq = itertools.count()
+
+        # Metrics
+        self._waits = deque(maxlen=1000)
+        self.admitted = 0
+        self.rejected_full = 0
+        self.rejected_timeout = 0
+
+    def acquire(self, priority: int = INTERACTIVE, queue_timeout: Optional[float] = None) -> float:
+        """
+        Wait for a slot.
+
+        Interactive requests are rejected when the queue is full or when they wait longer
+        than the queue-time budget. Background requests are never rejected for a full queue,
+        since their number is bounded by whoever submits them (e.g. the map job worker pool),
+        and only time out when the caller passes its own `queue_timeout`.
+
+        Returns:
+            float: Seconds spent queued
+
+        Raises:
+            AdmissionRejected: 429 if the queue is full, 503 if the budget ran out
+        """
+        start = time.monotonic()
+        with self._cond:
+            if self._active < self.max_concurrency and not self._waiters:
+                self._active += 1
+                return self._record_wait(start)
+
+            shed = priority == INTERACTIVE
+            if shed and len(self._waiters) >= self.max_queue:
+                self.rejected_full += 1
+                raise AdmissionRejected(f"The {self.name} service is busy, try again shortly", 429, 2)
+
+            waiter = [priority, next(self._seq), False]
+            heapq.heappush(self._waiters, waiter)
+            if shed:
+                budget = queue_timeout if queue_timeout is not None else self.queue_timeout
+                deadline = start + budget
+            else:
+                deadline = start + queue_timeout if queue_timeout is not None else None
+
+            while not waiter[2]:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    self._waiters.remove(waiter)
+                    heapq.heapify(self._waiters)
+                    self.rejected_timeout += 1
+                    raise AdmissionRejected(f"The {self.name} service is overloaded, try again shortly", 503, 5)
+                self._cond.wait(remaining)
+
+            return self._record_wait(start)
+
+    def release(self):
+        """Free a slot, handing it to the highest-priority waiter if there is one."""
+        with self._cond:
+            if self._waiters:
+                waiter = heapq.heappop(self._waiters)
+                waiter[2] = True
+                self._cond.notify_all()
+            else:
+                self._active -= 1
+
+    def _record_wait(self, start: float) -> float:
+        wait = time.monotonic() - start
+        self._waits.append(wait)
+        self.admitted += 1
+        return wait
+
+    def busy(self) -> bool:
+        """Whether every slot is taken, so new work would have to queue."""
+        with self._cond:
+            return self._active >= self.max_concurrency or bool(self._waiters)
+
+    def stats(self) -> Dict:
+        """Current load and queue-wait metrics."""
+        with self._cond:
+            waits = sorted(self._waits)
+            active, queued = self._active, len(self._waiters)
+
+        def quantile(q):
+            return waits[min(len(waits) - 1, int(q * len(waits)))] if waits else 0.0
+
+        return {
+            "active": active,
+            "queued": queued,
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+            "admitted": self.admitted,
+            "rejected_full": self.rejected_full,
+            "rejected_timeout": self.rejected_timeout,
+            "queue_wait_ms": {
+                "p50": round(quantile(0.5) * 1000, 2),
+                "p95": round(quantile(0.95) * 1000, 2),
+                "p99": round(quantile(0.99) * 1000, 2),
+                "max": round(waits[-1] * 1000, 2) if waits else 0.0,
+            },
+        }
+
+
+class WorkloadScheduler:
+    """Admission control in front of the RAG engines, with one lane per model type."""
+
+    def __init__(self, lanes: Dict[str, Lane]):
+        self.lanes = lanes
+
+    @classmethod
+    def from_env(cls) -> "WorkloadScheduler":
+        """
+        Lanes for the encyclopedia and map workloads, configurable through
+        SCHED_<LANE>_CONCURRENCY, SCHED_<LANE>_QUEUE and SCHED_<LANE>_QUEUE_TIMEOUT.
+        """
+        defaults = {
+            "encyclopedia": (8, 32, 5.0),
+            "map": (2, 8, 15.0),
+        }
+        lanes = {}
+        for name, (concurrency, queue, timeout) in defaults.items():
+            prefix = f"SCHED_{name.upper()}_"
+            lanes[name] = Lane(
+                name,
+                max_concurrency=int(os.getenv(prefix + "CONCURRENCY", concurrency)),
+                max_queue=int(os.getenv(prefix + "QUEUE", queue)),
+                queue_timeout=float(os.getenv(prefix + "QUEUE_TIMEOUT", timeout)),
+            )
+        return cls(lanes)
+
+    def run(self, lane: str, fn: Callable, *args, priority: int = INTERACTIVE,
+            queue_timeout: Optional[float] = None, **kwargs):
+        """
+        Run `fn(*args, **kwargs)` once the lane admits it.
+
+        Raises:
+            KeyError: If the lane does not exist
+            AdmissionRejected: If the request was shed
+        """
+        pool = self.lanes[lane]
+        pool.acquire(priority, queue_timeout)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            pool.release()
+
+    def busy(self, lane: str) -> bool:
+        """Whether a lane is saturated; optional work (e.g. prefetching) should back off."""
+        return self.lanes[lane].busy()
+
+    def thread_budget(self) -> int:
+        """Threads needed to hold every running and queued request of every lane."""
+        return sum(lane.max_concurrency + lane.max_queue for lane in self.lanes.values())
+
+    def stats(self) -> Dict[str, Dict]:
+        return {name: lane.stats() for name, lane in self.lanes.items()}
@@ -0,0 +1,191 @@
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+
+def default_cache_path() -> str:
+    """
+    Cache file location: SHARED_CACHE_PATH, else the temp directory.
+
+    Not /dev/shm by default: container tmpfs mounts are often only 64 MB, and a full one
+    makes every write fail. Point SHARED_CACHE_PATH there when it is known to be large enough.
+    """
+    if os.getenv("SHARED_CACHE_PATH"):
+        return os.getenv("SHARED_CACHE_PATH")
+    return os.path.join(tempfile.gettempdir(), "ski-sage-cache.sqlite3")
+
+
+class SharedCache:
+    """
+    Key/value cache shared by every worker process on a host.
+
+    Backed by a SQLite file in WAL mode, so forked workers see each other's entries without
+    each holding a private copy. Connections are opened lazily per process and per thread,
+    which keeps the cache safe to create before forking. Errors are logged and treated as
+    cache misses; the cache never fails a request.
+
+    Every namespace is capped by entries and by value bytes, and eviction only removes the
+    oldest entries of the namespace that is over its cap, so churn in one (e.g. embeddings)
+    cannot evict another's live entries (e.g. sessions).
+    """
+
+    def __init__(self, path: Optional[str] = None, max_entries: int = 100000, namespace: str = "",
+                 max_bytes: Optional[int] = None):
+        """
+        Args:
+            path (str): SQLite file path, defaults to default_cache_path()
+            max_entries (int): Entries of this namespace kept before the oldest are evicted
+            namespace (str): Prefix applied to every key
+            max_bytes (int): Value bytes of this namespace kept before the oldest are evicted,
+                defaults to SHARED_CACHE_MAX_MB (default 64) megabytes
+        """
+        self.path = path or default_cache_path()
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes or int(float(os.getenv("SHARED_CACHE_MAX_MB", "64")) * 1024 * 1024)
+        self.namespace = namespace
+        self._local = threading.local()
+        self._writes = 0
+        self._bytes_since_evict = 0
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+
+    def _connection(self) -> sqlite3.Connection:
+        """Return this thread's connection, reopening it after a fork."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=1.0, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=OFF")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                "key TEXT PRIMARY KEY, value BLOB, expires_at REAL, created_at REAL, size INTEGER)"
+            )
+            # Cache files created before the byte cap lack the size column
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(cache)")}
+            if "size" not in columns:
+                conn.execute("ALTER TABLE cache ADD COLUMN size INTEGER")
+            conn.execute("CREATE INDEX IF NOT EXISTS cache_created ON cache (created_at)")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, key: str) -> Optional[bytes]:
+        """Return the cached value, or None if missing or expired."""
+        try:
+            row = self._connection().execute(
+                "SELECT value, expires_at FROM cache WHERE key = ?", (self.namespace + key,)
+            ).fetchone()
+        except sqlite3.Error as e:
+            print(f"Shared cache read failed: {str(e)}")
+            return None
+        if row is None:
+            return None
+        value, expires_at = row
+        if expires_at is not None and expires_at < time.time():
+            return None
+        return value
+
+    def set(self, key: str, value: bytes, ttl: Optional[float] = None):
+        """Store a value, optionally expiring after `ttl` seconds."""
+        now = time.time()
+        try:
+            conn = self._connection()
+            conn.execute(
+                "INSERT OR REPLACE INTO cache (key, value, expires_at, created_at, size) VALUES (?, ?, ?, ?, ?)",
+                (self.namespace + key, value, now + ttl if ttl else None, now, len(value))
+            )
+            self._after_write(conn, len(value))
+        except sqlite3.Error as e:
+            self._write_failed(e)
+
+    def _after_write(self, conn: sqlite3.Connection, size: int):
+        """Evict every 1000 writes, or sooner once 5% of the byte cap was written since the last time."""
+        self._writes += 1
+        self._bytes_since_evict += size
+        if self._writes % 1000 == 0 or self._bytes_since_evict >= self.max_bytes // 20:
+            self._evict(conn)
+
+    def _write_failed(self, error: sqlite3.Error):
+        print(f"Shared cache write failed: {str(error)}")
+        if "full" in str(error).lower():
+            # Make room so later writes can succeed
+            try:
+                self._evict(self._connection())
+            except sqlite3.Error as e:
+                print(f"Shared cache eviction failed: {str(e)}")
+
+    def compare_and_set(self, key: str, expected: Optional[bytes], value: bytes,
+                        ttl: Optional[float] = None) -> bool:
+        """
+        Store a value only if the current one is still `expected` (None: missing or expired).
+
+        Returns:
+            bool: Whether the value was stored; False if another writer changed it first
+        """
+        now = time.time()
+        try:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute(
+                    "SELECT value, expires_at FROM cache WHERE key = ?", (self.namespace + key,)
+                ).fetchone()
+                current = row[0] if row is not None and (row[1] is None or row[1] >= now) else None
+                if current != expected:
+                    conn.execute("ROLLBACK")
+                    return False
+                conn.execute(
+                    "INSERT OR REPLACE INTO cache (key, value, expires_at, created_at, size) VALUES (?, ?, ?, ?, ?)",
+                    (self.namespace + key, value, now + ttl if ttl else None, now, len(value))
+                )
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            self._after_write(conn, len(value))
+            return True
+        except sqlite3.Error as e:
+            self._write_failed(e)
+            return False
+
+    def _evict(self, conn: sqlite3.Connection):
+        """Drop expired entries, then this namespace's oldest entries beyond max_entries or max_bytes."""
+        self._bytes_since_evict = 0
+        conn.execute("DELETE FROM cache WHERE expires_at IS NOT NULL AND expires_at < ?", (time.time(),))
+        conn.execute(
+            "DELETE FROM cache WHERE key IN ("
+            "SELECT key FROM ("
+            "SELECT key, ROW_NUMBER() OVER newest AS position, "
+            "SUM(COALESCE(size, length(value))) OVER newest AS total "
+            "FROM cache WHERE substr(key, 1, ?) = ? "
+            "WINDOW newest AS (ORDER BY created_at DESC ROWS UNBOUNDED PRECEDING)"
+            ") WHERE position > ? OR total > ?)",
+            (len(self.namespace), self.namespace, self.max_entries, self.max_bytes)
+        )
+
+    def delete(self, key: str):
+        """Remove a single entry."""
+        try:
+            self._connection().execute("DELETE FROM cache WHERE key = ?", (self.namespace + key,))
+        except sqlite3.Error as e:
+            print(f"Shared cache delete failed: {str(e)}")
+
+    def clear(self):
+        """Remove every entry in this cache's namespace."""
+        try:
+            self._connection().execute(
+                "DELETE FROM cache WHERE substr(key, 1, ?) = ?", (len(self.namespace), self.namespace)
+            )
+        except sqlite3.Error as e:
+            print(f"Shared cache clear failed: {str(e)}")
+
+    def __len__(self) -> int:
+        try:
+            return self._connection().execute(
+                "SELECT COUNT(*) FROM cache WHERE substr(key, 1, ?) = ?", (len(self.namespace), self.namespace)
+            ).fetchone()[0]
+        except sqlite3.Error:
+            return 0
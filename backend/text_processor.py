@@ -1,17 +1,31 @@
 import os
 import json
+import hashlib
 import PyPDF2
 from pathlib import Path
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Iterable
+import numpy as np
 from tqdm import tqdm
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from pinecone import Pinecone, ServerlessSpec
 from chromadb.utils import embedding_functions
 from dotenv import load_dotenv
+from vector_index import QuantizedIVFIndex
+from index_snapshots import SnapshotManager, IndexVersionMarker
+from near_duplicates import NearDuplicateFilter
+from facet_index import FacetIndex, TEXT_FACET_FIELDS
 
 load_dotenv()
 
 class TextProcessor:
+    # Pinecone caps metadata at 40KB per vector, so keep the per-chunk summary short
+    MAX_SUMMARY_CHARS = 1000
+    # Chunk metadata fields that retrieval can filter on
+    FACET_FIELDS = TEXT_FACET_FIELDS
+    EMBEDDING_MODEL = "all-MiniLM-L6-v2"
+    # Estimated Jaccard similarity above which a chunk is dropped as a near-duplicate
+    NEAR_DUPLICATE_THRESHOLD = float(os.getenv("NEAR_DUPLICATE_THRESHOLD", "0.8"))
+
     def __init__(self, data_dir: str = "data/texts"):
         self.data_dir = Path(data_dir)
         self.processed_dir = self.data_dir / "processed"
@@ -19,8 +33,8 @@ class TextProcessor:
         self.index_name = "ski-sage-summit"
         
         # Create necessary directories
-        self.processed_dir.mkdir(exist_ok=True)
-        self.chunks_dir.mkdir(exist_ok=True)
+        self.processed_dir.mkdir(parents=True, exist_ok=True)
+        self.chunks_dir.mkdir(parents=True, exist_ok=True)
         
         # Initialize Pinecone
         if not os.getenv("PINECONE_API_KEY"):
@@ -44,7 +58,7 @@ class TextProcessor:
         
         # Initialize ChromaDB embeddings
         self.embedding_function = embedding_functions.SentenceTransformerEmbeddingFunction(
-            model_name="all-MiniLM-L6-v2"
+            model_name=self.EMBEDDING_MODEL
         )
         
         # Initialize text splitter
@@ -115,35 +129,119 @@ class TextProcessor:
         
         return processed_docs
 
-    def create_chunks(self, processed_docs: List[Dict[str, Any]]):
-        """Create chunks from processed documents"""
+    def chunk_document(self, doc: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """Split a single document into chunks, keeping its structured fields as metadata"""
+        text_chunks = self.text_splitter.split_text(doc["text"])
+        
+        # Structured fields from the scraper travel with every chunk instead of a text header
+        extra_metadata = {}
+        if doc.get("url"):
+            extra_metadata["url"] = doc["url"]
+        if doc.get("summary"):
+            extra_metadata["summary"] = doc["summary"][:self.MAX_SUMMARY_CHARS]
+        if doc.get("categories"):
+            extra_metadata["categories"] = list(doc["categories"])
+        
+        # Lowercase copies of the facet fields so Pinecone filters match case-insensitively
+        base_metadata = {
+            "title": doc["title"],
+            "source": doc.get("source") or doc.get("url", ""),
+            **extra_metadata
+        }
+        for field in self.FACET_FIELDS:
+            if base_metadata.get(field):
+                base_metadata[f"{field}_key"] = FacetIndex.normalize(base_metadata[field])
+        
+        chunks = []
+        for i, chunk in enumerate(text_chunks):
+            chunk_data = {
+                "text": chunk,
+                "metadata": {
+                    **base_metadata,
+                    "chunk_index": i,
+                    "text": chunk  # Include text in metadata for retrieval
+                }
+            }
+            chunks.append(chunk_data)
+        return chunks
+
+    @staticmethod
+    def _safe_name(title: str) -> str:
+        """Filename-safe version of a document title"""
+        return ''.join(c if c.isalnum() or c in (' ', '_', '-') else '_' for c in title)
+
+    def _save_chunks(self, title: str, chunks: List[Dict]):
+        """Save the chunks of a document as a JSON artifact"""
+        chunk_file = self.chunks_dir / f"{self._safe_name(title)}_chunks.json"
+        with open(chunk_file, 'w', encoding='utf-8') as f:
+            json.dump(chunks, f, indent=2)
+
+    def _new_duplicate_filter(self, dedup: bool):
+        return NearDuplicateFilter(threshold=self.NEAR_DUPLICATE_THRESHOLD) if dedup else None
+
+    @staticmethod
+    def _merge_duplicate(kept: Dict, duplicate: Dict):
+        """Record where else a dropped near-duplicate chunk appeared on the chunk that was kept"""
+        source = duplicate["metadata"]["source"]
+        if source == kept["metadata"]["source"]:
+            return
+        also_in = kept["metadata"].setdefault("also_in", [])
+        if source not in also_in:
+            also_in.append(source)
+
+    def create_chunks(self, processed_docs: List[Dict[str, Any]], dedup: bool = True):
+        """
+        Create chunks from processed documents
+        
+        Args:
+            processed_docs: Documents as produced by process_files
+            dedup: Drop near-duplicate chunks, merging their source into the kept chunk's
+                "also_in" metadata
+        """
         all_chunks = []
+        duplicates = self._new_duplicate_filter(dedup)
         
         for doc in tqdm(processed_docs, desc="Creating chunks"):
-            text_chunks = self.text_splitter.split_text(doc["text"])
+            chunks = self.chunk_document(doc)
             
-            chunks = []
-            for i, chunk in enumerate(text_chunks):
-                chunk_data = {
-                    "text": chunk,
-                    "metadata": {
-                        "title": doc["title"],
-                        "source": doc["source"],
-                        "chunk_index": i,
-                        "text": chunk  # Include text in metadata for retrieval
-                    }
-                }
-                chunks.append(chunk_data)
+            if duplicates is not None:
+                # Kept chunks are numbered in keep order, which is their position in all_chunks
+                kept = []
+                for chunk, duplicate_of in zip(chunks, duplicates.check([c["text"] for c in chunks])):
+                    if duplicate_of is None:
+                        kept.append(chunk)
+                        all_chunks.append(chunk)
+                    else:
+                        self._merge_duplicate(all_chunks[duplicate_of], chunk)
+                chunks = kept
+            else:
+                all_chunks.extend(chunks)
             
             # Save chunks
-            chunk_file = self.chunks_dir / f"{doc['title']}_chunks.json"
-            with open(chunk_file, 'w', encoding='utf-8') as f:
-                json.dump(chunks, f, indent=2)
-            
-            all_chunks.extend(chunks)
+            self._save_chunks(doc["title"], chunks)
         
+        if duplicates is not None:
+            print(duplicates.report())
         return all_chunks
 
+    def _upsert_batch(self, ids: List[str], batch: List[Dict]):
+        """Embed a batch of chunks and upsert them to Pinecone"""
+        # Generate embeddings for the batch
+        texts = [chunk["text"] for chunk in batch]
+        embeddings = self.embedding_function(texts)
+        
+        # Prepare vectors for Pinecone
+        vectors = []
+        for vector_id, chunk, embedding in zip(ids, batch, embeddings):
+            vectors.append({
+                "id": vector_id,
+                "values": embedding.tolist(),
+                "metadata": chunk["metadata"]
+            })
+        
+        # Upsert to Pinecone
+        self.index.upsert(vectors=vectors)
+
     def add_to_pinecone(self, chunks: List[Dict]):
         """Add chunks to Pinecone"""
         # Clear existing index using the correct delete API
@@ -153,24 +251,182 @@ class TextProcessor:
         batch_size = 100
         for i in tqdm(range(0, len(chunks), batch_size), desc="Adding to Pinecone"):
             batch = chunks[i:i + batch_size]
+            ids = [f"chunk_{i + j}" for j in range(len(batch))]
+            self._upsert_batch(ids, batch)
+        IndexVersionMarker(self.index_name).bump()
+
+    @staticmethod
+    def _doc_id_prefix(source: str, title: str) -> str:
+        """Vector ID prefix shared by all chunks of one document"""
+        digest = hashlib.sha1(f"{source}|{title}".encode("utf-8")).hexdigest()[:16]
+        return f"doc_{digest}_"
+
+    @classmethod
+    def _stream_chunk_id(cls, chunk: Dict) -> str:
+        """Stable vector ID for a streamed chunk so re-ingesting an article overwrites it"""
+        metadata = chunk["metadata"]
+        return f"{cls._doc_id_prefix(metadata['source'], metadata['title'])}{metadata['chunk_index']}"
+
+    def _delete_stale_vectors(self, doc: Dict[str, Any], chunks: List[Dict]) -> int:
+        """
+        Delete a document's vectors from an earlier ingest that its new chunks will not overwrite,
+        e.g. when the article got shorter or a chunk is now dropped as a near-duplicate.
+        
+        Returns:
+            int: Number of vectors deleted
+        """
+        prefix = self._doc_id_prefix(doc.get("source") or doc.get("url", ""), doc["title"])
+        keep = {self._stream_chunk_id(chunk) for chunk in chunks}
+        try:
+            stale = [vector_id for ids in self.index.list(prefix=prefix) for vector_id in ids
+                     if vector_id not in keep]
+        except Exception as e:
+            print(f"Warning: Could not list vectors of {doc['title']}: {str(e)}")
+            return 0
+        for i in range(0, len(stale), 1000):
+            self.index.delete(ids=stale[i:i + 1000])
+        return len(stale)
+
+    def ingest_stream(self, documents: Iterable[Dict[str, Any]], batch_size: int = 100,
+                      save_artifacts: bool = False, dedup: bool = True) -> int:
+        """
+        Chunk, embed and upsert documents as they arrive, without staging them on disk.
+        
+        Args:
+            documents: Iterable of dicts with at least "title" and "text"
+                (e.g. WikiSkiScraper.iter_articles())
+            batch_size: Number of chunks embedded and upserted together
+            save_artifacts: Also write the processed/chunk JSON files
+            dedup: Drop chunks that near-duplicate one already ingested in this run, before
+                they are embedded
             
-            # Generate embeddings for the batch
-            texts = [chunk["text"] for chunk in batch]
-            embeddings = self.embedding_function(texts)
+        Returns:
+            int: Number of chunks upserted
+        """
+        pending = []
+        total_docs = 0
+        total_chunks = 0
+        total_deleted = 0
+        duplicates = self._new_duplicate_filter(dedup)
+        
+        for doc in documents:
+            if not doc.get("text"):
+                print(f"Warning: No text for {doc.get('title')}")
+                continue
+            
+            chunks = self.chunk_document(doc)
+            if duplicates is not None:
+                # Kept chunks may already be upserted, so duplicates are dropped rather than merged
+                flags = duplicates.check([c["text"] for c in chunks])
+                chunks = [chunk for chunk, duplicate_of in zip(chunks, flags) if duplicate_of is None]
+            if save_artifacts:
+                processed_file = self.processed_dir / f"{self._safe_name(doc['title'])}_processed.json"
+                with open(processed_file, 'w', encoding='utf-8') as f:
+                    json.dump(doc, f, indent=2)
+                self._save_chunks(doc["title"], chunks)
             
-            # Prepare vectors for Pinecone
-            vectors = []
-            for j, (chunk, embedding) in enumerate(zip(batch, embeddings)):
-                vectors.append({
-                    "id": f"chunk_{i + j}",
-                    "values": embedding.tolist(),
-                    "metadata": chunk["metadata"]
-                })
+            total_deleted += self._delete_stale_vectors(doc, chunks)
+            pending.extend(chunks)
+            total_docs += 1
+            
+            # Flush full batches while the next documents are still being produced
+            while len(pending) >= batch_size:
+                batch, pending = pending[:batch_size], pending[batch_size:]
+                self._upsert_batch([self._stream_chunk_id(c) for c in batch], batch)
+                total_chunks += len(batch)
+        
+        if pending:
+            self._upsert_batch([self._stream_chunk_id(c) for c in pending], pending)
+            total_chunks += len(pending)
+        
+        print(f"Streamed {total_docs} documents ({total_chunks} chunks) into Pinecone, "
+              f"deleted {total_deleted} stale vectors")
+        if total_chunks or total_deleted:
+            IndexVersionMarker(self.index_name).bump()
+        if duplicates is not None:
+            print(duplicates.report())
+        return total_chunks
+
+    def build_local_index(self, chunks: List[Dict], index_dir: str = "data/index/text",
+                          quantization: str = "int8") -> QuantizedIVFIndex:
+        """
+        Embed chunks and build a local quantized ANN index from them.
+        
+        Args:
+            chunks: Chunks as produced by create_chunks / chunk_document
+            index_dir: Output directory for the index files
+            quantization: "int8" or "pq"
             
-            # Upsert to Pinecone
-            self.index.upsert(vectors=vectors)
+        Returns:
+            QuantizedIVFIndex: The built index
+        """
+        batch_size = 100
+        embeddings = np.zeros((len(chunks), 384), dtype=np.float32)
+        for i in tqdm(range(0, len(chunks), batch_size), desc="Embedding chunks"):
+            texts = [chunk["text"] for chunk in chunks[i:i + batch_size]]
+            embeddings[i:i + len(texts)] = np.asarray(self.embedding_function(texts), dtype=np.float32)
+        
+        records = [
+            {"id": f"chunk_{i}", "metadata": chunk["metadata"]}
+            for i, chunk in enumerate(chunks)
+        ]
+        index = QuantizedIVFIndex.build(embeddings, records, index_dir, quantization=quantization,
+                                        facet_fields=self.FACET_FIELDS)
+        print(f"Built local {quantization} index with {index.count} vectors "
+              f"({index.bytes_per_vector} bytes/vector) in {index_dir}")
+        return index
+
+    @staticmethod
+    def _content_hash(text: str) -> str:
+        """Hash identifying a chunk's embedding: same model and text give the same vector"""
+        return hashlib.sha1(f"{TextProcessor.EMBEDDING_MODEL}\n{text}".encode("utf-8")).hexdigest()
 
-    def process_all(self):
+    def build_snapshot(self, chunks: List[Dict], quantization: str = "int8", activate: bool = True) -> str:
+        """
+        Build a complete new versioned index snapshot next to the one being served.
+        
+        Chunks whose text is unchanged since the current snapshot reuse its vectors instead
+        of being re-embedded. The snapshot is validated and, if activate is set, atomically
+        switched in; running servers pick it up without a restart.
+        
+        Returns:
+            str: The new snapshot version
+        """
+        manager = SnapshotManager("text")
+        reusable = manager.reusable_embeddings()
+        
+        hashes = [self._content_hash(chunk["text"]) for chunk in chunks]
+        embeddings = np.zeros((len(chunks), 384), dtype=np.float32)
+        missing = []
+        for i, content_hash in enumerate(hashes):
+            if content_hash in reusable:
+                embeddings[i] = reusable[content_hash]
+            else:
+                missing.append(i)
+        print(f"Reusing {len(chunks) - len(missing)} embeddings, embedding {len(missing)} new chunks")
+        
+        batch_size = 100
+        for start in tqdm(range(0, len(missing), batch_size), desc="Embedding chunks"):
+            rows = missing[start:start + batch_size]
+            texts = [chunks[i]["text"] for i in rows]
+            embeddings[rows] = np.asarray(self.embedding_function(texts), dtype=np.float32)
+        
+        records = [
+            {"id": f"chunk_{i}", "metadata": chunk["metadata"], "hash": content_hash}
+            for i, (chunk, content_hash) in enumerate(zip(chunks, hashes))
+        ]
+        version = manager.new_version()
+        index = QuantizedIVFIndex.build(embeddings, records, str(manager.path(version)),
+                                        quantization=quantization, facet_fields=self.FACET_FIELDS)
+        report = manager.validate(index)
+        print(f"Built text snapshot {version}: {report}")
+        
+        if activate:
+            manager.activate(version)
+        return version
+
+    def process_all(self, local_index_dir: str = None, quantization: str = "int8",
+                    snapshot: bool = False, dedup: bool = True):
         """Run the complete processing pipeline"""
         print("Starting text processing pipeline...")
         
@@ -179,14 +435,35 @@ class TextProcessor:
         print(f"Processed {len(processed_docs)} documents")
         
         # Create chunks
-        chunks = self.create_chunks(processed_docs)
+        chunks = self.create_chunks(processed_docs, dedup=dedup)
         print(f"Created {len(chunks)} chunks")
         
+        if snapshot:
+            # Build and switch to a new versioned snapshot instead of writing the live index
+            self.build_snapshot(chunks, quantization)
+            return
+        
+        if local_index_dir:
+            # Build the local quantized index instead of uploading
+            self.build_local_index(chunks, local_index_dir, quantization)
+            return
+        
         # Add to Pinecone
         self.add_to_pinecone(chunks)
         print("Documents added to Pinecone")
 
 
 if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Process documents into the vector index")
+    parser.add_argument("--local-index", default=None,
+                        help="Build a local quantized index in this directory instead of using Pinecone")
+    parser.add_argument("--snapshot", action="store_true",
+                        help="Build a new versioned local snapshot and switch serving to it")
+    parser.add_argument("--quantization", choices=["int8", "pq"], default="int8")
+    parser.add_argument("--no-dedup", action="store_true", help="Keep near-duplicate chunks")
+    args = parser.parse_args()
+    
     text_processor = TextProcessor()
-    text_processor.process_all()
\ No newline at end of file
+    text_processor.process_all(local_index_dir=args.local_index, quantization=args.quantization,
+                               snapshot=args.snapshot, dedup=not args.no_dedup)
\ No newline at end of file
@@ -0,0 +1,312 @@
+import json
+import mmap
+import time
+import numpy as np
+from pathlib import Path
+from typing import List, Dict, Optional, Tuple
+from facet_index import FacetIndex
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    """L2-normalize rows so inner product equals cosine similarity."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def _assign(data: np.ndarray, centroids: np.ndarray, block_size: int = 8192) -> np.ndarray:
+    """Assign each row to its nearest centroid (L2), in blocks to bound memory."""
+    centroid_norms = (centroids ** 2).sum(axis=1)
+    assignments = np.empty(len(data), dtype=np.int64)
+    for start in range(0, len(data), block_size):
+        block = data[start:start + block_size]
+        # ||x - c||^2 = ||x||^2 - 2 x.c + ||c||^2, and ||x||^2 is constant per row
+        distances = centroid_norms[None, :] - 2.0 * (block @ centroids.T)
+        assignments[start:start + block_size] = distances.argmin(axis=1)
+    return assignments
+
+
+def _kmeans(data: np.ndarray, k: int, n_iter: int = 20, seed: int = 0,
+            spherical: bool = False) -> np.ndarray:
+    """Plain Lloyd's k-means; spherical mode keeps centroids unit-length."""
+    rng = np.random.default_rng(seed)
+    k = min(k, len(data))
+    centroids = data[rng.choice(len(data), k, replace=False)].copy()
+    for _ in range(n_iter):
+        assignments = _assign(data, centroids)
+
+        # Sum members per cluster with a sort + reduceat instead of a slow np.add.at
+        order = np.argsort(assignments, kind="stable")
+        counts = np.bincount(assignments, minlength=k)
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        non_empty = counts > 0
+        sums = np.add.reduceat(data[order], starts[non_empty], axis=0)
+        centroids[non_empty] = sums / counts[non_empty, None]
+
+        # Re-seed empty clusters from random points
+        if (~non_empty).any():
+            centroids[~non_empty] = data[rng.choice(len(data), int((~non_empty).sum()), replace=False)]
+        if spherical:
+            centroids = _normalize(centroids)
+    return centroids.astype(np.float32)
+
+
+class QuantizedIVFIndex:
+    """
+    Local inverted-file (IVF) vector index with int8 or product-quantized codes.
+
+    Vectors are bucketed by their nearest coarse centroid and stored contiguously per
+    bucket as compact codes in a memory-mapped file. A query scores the codes of the
+    `nprobe` closest buckets, then re-ranks the shortlist against the full-precision
+    vectors, which stay on disk and are only paged in for the shortlisted rows.
+    """
+
+    MANIFEST = "manifest.json"
+    FACETS = "facets"
+    # Filters selecting at most this fraction of rows are scanned directly instead of via IVF
+    BRUTE_FORCE_FRACTION = 0.05
+
+    def __init__(self, index_dir: str):
+        """
+        Open an index previously written by `QuantizedIVFIndex.build`.
+
+        Args:
+            index_dir (str): Directory containing the index files
+        """
+        self.index_dir = Path(index_dir)
+        with open(self.index_dir / self.MANIFEST, "r") as f:
+            self.manifest = json.load(f)
+
+        self.dim = self.manifest["dim"]
+        self.count = self.manifest["count"]
+        self.quantization = self.manifest["quantization"]
+        self.nprobe = self.manifest.get("nprobe", 8)
+
+        # Small arrays live in memory, per-vector arrays are memory-mapped
+        self.centroids = np.load(self.index_dir / "centroids.npy")
+        self.list_offsets = np.load(self.index_dir / "list_offsets.npy")
+        self.codes = np.load(self.index_dir / "codes.npy", mmap_mode="r")
+        self.vectors = np.load(self.index_dir / "vectors.npy", mmap_mode="r")
+        if self.quantization == "int8":
+            self.scale = np.load(self.index_dir / "scale.npy")
+        else:
+            self.codebooks = np.load(self.index_dir / "codebooks.npy")
+
+        # Row metadata is JSON lines addressed by byte offsets
+        self.metadata_offsets = np.load(self.index_dir / "metadata_offsets.npy")
+        self._metadata_file = open(self.index_dir / "metadata.jsonl", "rb")
+        self._metadata_map = mmap.mmap(self._metadata_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        # Optional facet bitmaps for filtered search
+        facets_path = self.index_dir / self.FACETS
+        self.facets = FacetIndex.load(str(facets_path)) if FacetIndex.exists(str(facets_path)) else None
+
+    @property
+    def bytes_per_vector(self) -> int:
+        """Resident bytes per vector used for approximate scoring."""
+        return int(self.codes.shape[1] * self.codes.dtype.itemsize)
+
+    @classmethod
+    def build(cls,
+              embeddings: np.ndarray,
+              records: List[Dict],
+              index_dir: str,
+              quantization: str = "int8",
+              nlist: Optional[int] = None,
+              pq_m: Optional[int] = None,
+              nprobe: int = 8,
+              facet_fields: Optional[List[str]] = None,
+              seed: int = 0) -> "QuantizedIVFIndex":
+        """
+        Build an index from embeddings and write it to disk.
+
+        Args:
+            embeddings (np.ndarray): (n, dim) float vectors
+            records (List[Dict]): One {"id": ..., "metadata": {...}} record per vector,
+                optionally with a "hash" of the embedded content
+            index_dir (str): Output directory
+            quantization (str): "int8" (4x smaller) or "pq" (dim / pq_m times smaller)
+            nlist (int): Number of IVF buckets, defaults to ~4 * sqrt(n)
+            pq_m (int): Number of PQ sub-quantizers, defaults to dim // 4 (16x smaller)
+            nprobe (int): Default number of buckets scanned per query
+            facet_fields (List[str]): Metadata fields to build filter bitmaps for
+            seed (int): Random seed for k-means
+
+        Returns:
+            QuantizedIVFIndex: The opened index
+        """
+        if quantization not in ("int8", "pq"):
+            raise ValueError(f"Unsupported quantization: {quantization}")
+        vectors = _normalize(embeddings)
+        if vectors.ndim != 2 or len(vectors) == 0:
+            raise ValueError("Cannot build an index from an empty embedding matrix")
+        if len(records) != len(vectors):
+            raise ValueError("Number of records does not match number of embeddings")
+        count, dim = vectors.shape
+
+        index_dir = Path(index_dir)
+        index_dir.mkdir(parents=True, exist_ok=True)
+        rng = np.random.default_rng(seed)
+
+        # Train coarse centroids on a sample
+        nlist = nlist or max(1, int(4 * np.sqrt(count)))
+        nlist = min(nlist, count)
+        sample_size = min(count, max(nlist * 64, 10000))
+        sample = vectors[rng.choice(count, sample_size, replace=False)]
+        centroids = _kmeans(sample, nlist, seed=seed, spherical=True)
+        nlist = len(centroids)
+
+        # Group rows by bucket so each bucket is a contiguous slice
+        assignments = _assign(vectors, centroids)
+        order = np.argsort(assignments, kind="stable")
+        vectors = vectors[order]
+        records = [records[i] for i in order]
+        counts = np.bincount(assignments, minlength=nlist)
+        list_offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+
+        # Quantize
+        if quantization == "int8":
+            scale = np.abs(vectors).max(axis=0) / 127.0
+            scale[scale == 0] = 1.0
+            codes = np.clip(np.rint(vectors / scale), -127, 127).astype(np.int8)
+            np.save(index_dir / "scale.npy", scale.astype(np.float32))
+        else:
+            pq_m = pq_m or max(1, dim // 4)
+            if dim % pq_m != 0:
+                raise ValueError(f"pq_m={pq_m} must divide the embedding dimension {dim}")
+            dsub = dim // pq_m
+            ksub = min(256, count)
+            pq_sample = vectors[rng.choice(count, min(count, 256 * 64), replace=False)]
+            codebooks = np.zeros((pq_m, 256, dsub), dtype=np.float32)
+            codes = np.empty((count, pq_m), dtype=np.uint8)
+            for m in range(pq_m):
+                sub = slice(m * dsub, (m + 1) * dsub)
+                codebooks[m, :ksub] = _kmeans(pq_sample[:, sub], ksub, n_iter=15, seed=seed + m)
+                codes[:, m] = _assign(vectors[:, sub], codebooks[m, :ksub])
+            np.save(index_dir / "codebooks.npy", codebooks)
+
+        np.save(index_dir / "centroids.npy", centroids)
+        np.save(index_dir / "list_offsets.npy", list_offsets)
+        np.save(index_dir / "codes.npy", codes)
+        np.save(index_dir / "vectors.npy", vectors)
+
+        # Metadata as JSON lines with byte offsets for random access
+        offsets = [0]
+        with open(index_dir / "metadata.jsonl", "wb") as f:
+            for record in records:
+                line = (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+                f.write(line)
+                offsets.append(offsets[-1] + len(line))
+        np.save(index_dir / "metadata_offsets.npy", np.asarray(offsets, dtype=np.int64))
+
+        # Content hashes in row order let a later build reuse these vectors
+        if all("hash" in record for record in records):
+            np.save(index_dir / "hashes.npy", np.asarray([record["hash"] for record in records], dtype="S64"))
+
+        if facet_fields:
+            facets = FacetIndex.build([record.get("metadata", {}) for record in records], facet_fields)
+            facets.save(str(index_dir / cls.FACETS))
+
+        manifest = {
+            "dim": int(dim),
+            "count": int(count),
+            "nlist": int(nlist),
+            "nprobe": int(nprobe),
+            "quantization": quantization,
+            "pq_m": int(pq_m) if quantization == "pq" else None,
+            "metric": "cosine",
+            "created_at": time.time()
+        }
+        with open(index_dir / cls.MANIFEST, "w") as f:
+            json.dump(manifest, f, indent=2)
+
+        return cls(str(index_dir))
+
+    def _approximate_scores(self, rows: np.ndarray, query: np.ndarray) -> np.ndarray:
+        """Score rows from their quantized codes."""
+        codes = self.codes[rows]
+        if self.quantization == "int8":
+            return codes.astype(np.float32) @ (query * self.scale)
+
+        # Asymmetric distance: per sub-quantizer lookup table of query . codeword
+        pq_m, _, dsub = self.codebooks.shape
+        tables = np.einsum("mkd,md->mk", self.codebooks, query.reshape(pq_m, dsub))
+        return tables[np.arange(pq_m), codes].sum(axis=1)
+
+    def search(self,
+               query: np.ndarray,
+               k: int = 5,
+               nprobe: Optional[int] = None,
+               rerank: Optional[int] = None,
+               mask: Optional[np.ndarray] = None,
+               filters: Optional[Dict] = None) -> List[Tuple[int, float]]:
+        """
+        Search the index for the vectors most similar to a query.
+
+        Args:
+            query (np.ndarray): Query embedding
+            k (int): Number of results to return
+            nprobe (int): Number of buckets to scan, defaults to the index setting
+            rerank (int): Shortlist size re-ranked with exact vectors, defaults to 10 * k
+            mask (np.ndarray): Optional boolean array over rows; only True rows are scored
+            filters (Dict): Optional metadata filters resolved through the facet bitmaps
+
+        Returns:
+            List[Tuple[int, float]]: (row, cosine similarity) pairs, best first
+        """
+        query = _normalize(query).reshape(-1)
+
+        if filters:
+            if self.facets is None:
+                raise ValueError("This index was built without facet fields")
+            filter_mask = self.facets.mask(filters)
+            mask = filter_mask if mask is None else mask & filter_mask
+
+        if mask is not None:
+            # Narrow filters: score the matching rows directly, skipping the coarse quantizer
+            candidates = np.flatnonzero(mask)
+            if len(candidates) <= max(self.BRUTE_FORCE_FRACTION * self.count, rerank or 10 * k):
+                return self._score_rows(candidates, query, k, rerank)
+
+        nprobe = min(nprobe or self.nprobe, len(self.centroids))
+
+        # Pick the closest buckets and gather their row ranges
+        centroid_scores = self.centroids @ query
+        probe = np.argpartition(-centroid_scores, nprobe - 1)[:nprobe]
+        rows = np.concatenate([
+            np.arange(self.list_offsets[l], self.list_offsets[l + 1]) for l in probe
+        ])
+        if mask is not None:
+            rows = rows[mask[rows]]
+        return self._score_rows(rows, query, k, rerank)
+
+    def _score_rows(self, rows: np.ndarray, query: np.ndarray, k: int,
+                    rerank: Optional[int]) -> List[Tuple[int, float]]:
+        """Approximate-score candidate rows, then exactly re-rank the shortlist."""
+        if len(rows) == 0:
+            return []
+        rows = np.sort(rows)
+
+        shortlist_size = min(len(rows), rerank or 10 * k)
+        approximate = self._approximate_scores(rows, query)
+        if shortlist_size < len(rows):
+            shortlist = rows[np.argpartition(-approximate, shortlist_size - 1)[:shortlist_size]]
+        else:
+            shortlist = rows
+        shortlist = np.sort(shortlist)
+
+        exact = np.asarray(self.vectors[shortlist], dtype=np.float32) @ query
+        top = np.argsort(-exact)[:k]
+        return [(int(shortlist[i]), float(exact[i])) for i in top]
+
+    def record(self, row: int) -> Dict:
+        """Return the {"id", "metadata"} record stored for a row."""
+        start, end = self.metadata_offsets[row], self.metadata_offsets[row + 1]
+        return json.loads(self._metadata_map[start:end].decode("utf-8"))
+
+    def close(self):
+        """Release the memory-mapped metadata file."""
+        self._metadata_map.close()
+        self._metadata_file.close()
+
@@ -0,0 +1,122 @@
+import argparse
+import json
+import os
+import time
+from collections import Counter
+from typing import Dict, List
+
+import numpy as np
+
+from query_log import QueryLog, normalize_query
+
+
+def cluster_queries(counts: Counter, embeddings: Dict[str, np.ndarray], threshold: float) -> List[Dict]:
+    """
+    Greedily group normalized queries whose embeddings are within `threshold` cosine
+    similarity of a cluster's most frequent query.
+
+    Returns:
+        List[Dict]: Clusters as {"representative", "aliases", "count"}, most frequent first
+    """
+    clusters = []
+    for query, count in counts.most_common():
+        vector = embeddings[query]
+        for cluster in clusters:
+            if float(vector @ cluster["vector"]) >= threshold:
+                cluster["aliases"].append(query)
+                cluster["count"] += count
+                break
+        else:
+            clusters.append({"representative": query, "aliases": [query], "count": count, "vector": vector})
+    clusters.sort(key=lambda cluster: -cluster["count"])
+    for cluster in clusters:
+        del cluster["vector"]
+    return clusters
+
+
+def build_warm_cache(rag, log: QueryLog, output_path: str, top_n: int = 200, min_count: int = 2,
+                     days: float = 7.0, threshold: float = 0.92, with_answers: bool = True) -> int:
+    """
+    Precompute embeddings, retrieval results and answers for the most frequent queries.
+
+    Args:
+        rag (EncyclopediaRAG): Engine whose caches will be warmed
+        log (QueryLog): Query log to mine
+        output_path (str): Where to write the warm cache file
+        top_n (int): Number of query clusters to precompute
+        min_count (int): Minimum number of times a cluster must have been asked
+        days (float): How far back in the log to look
+        threshold (float): Cosine similarity for grouping paraphrases together
+        with_answers (bool): Also precompute LLM answers
+
+    Returns:
+        int: Number of entries written
+    """
+    counts = Counter()
+    raw_forms: Dict[str, Counter] = {}
+    for entry in log.read(since=time.time() - days * 86400):
+        normalized = entry.get("normalized") or normalize_query(entry["query"])
+        counts[normalized] += 1
+        raw_forms.setdefault(normalized, Counter())[entry["query"]] += 1
+    if not counts:
+        print("Query log is empty, nothing to warm")
+        return 0
+
+    # Embed the distinct normalized queries in one batch
+    queries = list(counts)
+    vectors = np.asarray(rag.embedding_function(queries), dtype=np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True) + 1e-9
+    clusters = cluster_queries(counts, dict(zip(queries, vectors)), threshold)
+    clusters = [cluster for cluster in clusters if cluster["count"] >= min_count][:top_n]
+
+    entries = []
+    for cluster in clusters:
+        # Answer the most common wording of the cluster's representative query
+        query = raw_forms[cluster["representative"]].most_common(1)[0][0]
+        matches = rag.retrieve_scored_chunks(query)
+        entry = {
+            "query": query,
+            "aliases": cluster["aliases"],
+            "count": cluster["count"],
+            "embedding": rag._embed_query(query),
+            "matches": matches,
+            "answer": None,
+        }
+        if with_answers:
+            entry["answer"] = rag.generate_response(query, matches=matches)
+        entries.append(entry)
+        print(f"Precomputed ({cluster['count']}x, {len(cluster['aliases'])} variants): {query}")
+
+    warm = {"index_version": rag.index_version, "created_at": time.time(), "entries": entries}
+    tmp_path = f"{output_path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(warm, f, ensure_ascii=False)
+    os.replace(tmp_path, output_path)
+    print(f"Wrote {len(entries)} warm cache entries to {output_path}")
+    return len(entries)
+
+
+if __name__ == "__main__":
+    from encyclopedia_rag import EncyclopediaRAG
+
+    parser = argparse.ArgumentParser(description="Precompute answers for frequent queries from the query log")
+    parser.add_argument("--output", default=os.getenv("WARM_CACHE_PATH", "data/warm_cache.json"))
+    parser.add_argument("--top", type=int, default=200, help="Number of query clusters to precompute")
+    parser.add_argument("--min-count", type=int, default=2, help="Minimum times a question was asked")
+    parser.add_argument("--days", type=float, default=7.0, help="Days of query log to consider")
+    parser.add_argument("--threshold", type=float, default=0.92, help="Cosine similarity for grouping paraphrases")
+    parser.add_argument("--no-answers", action="store_true", help="Only precompute embeddings and retrieval")
+    args = parser.parse_args()
+
+    # Answers generated here must not be logged as user traffic
+    os.environ["QUERY_LOG_ENABLED"] = "0"
+    build_warm_cache(
+        EncyclopediaRAG(),
+        QueryLog(),
+        args.output,
+        top_n=args.top,
+        min_count=args.min_count,
+        days=args.days,
+        threshold=args.threshold,
+        with_answers=not args.no_answers,
+    )
@@ -87,9 +87,10 @@ Full Article:
         
         return filepath
 
-    def scrape_all(self, output_dir='data/texts', max_pages=100):
-        """Scrape all skiing-related content and save as text files"""
-        os.makedirs(output_dir, exist_ok=True)
+    def iter_articles(self, max_pages=100, output_dir=None):
+        """Yield scraped articles one at a time, optionally saving text files as a side artifact"""
+        if output_dir:
+            os.makedirs(output_dir, exist_ok=True)
         
         # Set to keep track of processed pages
         processed_pages = set()
@@ -111,13 +112,15 @@ Full Article:
             # Scrape current page
             content = self.scrape_page(current_page)
             if content:
-                # Save as text file
-                filepath = self.save_as_text_file(content, output_dir)
+                filepath = None
+                if output_dir:
+                    # Save as text file
+                    filepath = self.save_as_text_file(content, output_dir)
                 
                 # Add to metadata
                 metadata.append({
                     'title': content['title'],
-                    'file': os.path.basename(filepath),
+                    'file': os.path.basename(filepath) if filepath else None,
                     'url': content['url'],
                     'categories': content['categories']
                 })
@@ -128,16 +131,24 @@ Full Article:
                 related = self.get_related_pages(self.wiki.page(current_page))
                 pages_to_process.extend([p for p in related if p not in processed_pages])
                 
+                yield content
+                
             # Rate limiting to be nice to Wikipedia
             time.sleep(1)
             
             # Save metadata periodically
-            if len(metadata) % 10 == 0:
+            if output_dir and len(metadata) % 10 == 0:
                 self._save_metadata(metadata, output_dir)
                 
         # Final metadata save
-        self._save_metadata(metadata, output_dir)
+        if output_dir:
+            self._save_metadata(metadata, output_dir)
         print(f"Scraping complete! Processed {len(metadata)} pages.")
+
+    def scrape_all(self, output_dir='data/texts', max_pages=100):
+        """Scrape all skiing-related content and save as text files"""
+        for _ in self.iter_articles(max_pages=max_pages, output_dir=output_dir):
+            pass
         
     def _save_metadata(self, metadata, output_dir):
         """Save metadata about all scraped articles"""
@@ -1,5 +1,6 @@
 import { useRef } from 'react';
 import ModelToggle from './ModelToggle';
+import usePrefetch from '../../hooks/usePrefetch';
 import { MountainSnow } from 'lucide-react';
 
 export default function ChatInput({ 
@@ -11,6 +12,7 @@ export default function ChatInput({
   setSelectedModel
 }) {
   const textareaRef = useRef(null);
+  usePrefetch(input, selectedModel);
 
   const handleChange = (e) => {
     setInput(e.target.value);
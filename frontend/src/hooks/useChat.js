@@ -1,4 +1,38 @@
 import { useState, useRef, useEffect, useCallback } from 'react';
+import { PREFETCH_ID } from './usePrefetch';
+
+const MAP_JOB_POLL_INTERVAL_MS = 1500;
+
+// Map generation runs as a background job on the server: submit it, then poll until it finishes
+async function runMapJob(backendUrl, message) {
+  const submitResponse = await fetch(`${backendUrl}/api/map/jobs`, {
+    method: 'POST',
+    headers: {
+      'Content-Type': 'application/json',
+    },
+    body: JSON.stringify({ message, prefetchId: PREFETCH_ID }),
+  });
+
+  if (!submitResponse.ok) {
+    const errorData = await submitResponse.json();
+    throw new Error(errorData.detail || 'Failed to start map generation');
+  }
+
+  let job = await submitResponse.json();
+  while (job.status !== 'succeeded' && job.status !== 'failed') {
+    await new Promise(resolve => setTimeout(resolve, MAP_JOB_POLL_INTERVAL_MS));
+    const pollResponse = await fetch(`${backendUrl}/api/map/jobs/${job.jobId}`);
+    if (!pollResponse.ok) {
+      throw new Error('Failed to get map generation status');
+    }
+    job = await pollResponse.json();
+  }
+
+  if (job.status === 'failed') {
+    throw new Error(job.error || 'Map generation failed');
+  }
+  return job.response;
+}
 
 export default function useChat() {
   const [messages, setMessages] = useState([]);
@@ -14,7 +48,7 @@ export default function useChat() {
     };
   }, []);
 
-  const handleSubmit = useCallback(async (e, modelType) => {
+  const handleSubmit = useCallback(async (e, modelType, conversationId) => {
     e.preventDefault();
     if (!input.trim()) return;
 
@@ -27,6 +61,17 @@ export default function useChat() {
     setError(null);
 
     try {
+      if (modelType === 'map') {
+        const imageUrl = await runMapJob(process.env.NEXT_PUBLIC_BACKEND_URL, userInput);
+        if (isMounted.current) {
+          setMessages(prev => [...prev, {
+            role: 'assistant',
+            content: imageUrl
+          }]);
+        }
+        return;
+      }
+
       // Use absolute URL for production
       const apiUrl = `${process.env.NEXT_PUBLIC_BACKEND_URL}/api/chat`;
       
@@ -38,7 +83,9 @@ export default function useChat() {
         body: JSON.stringify({ 
           message: userInput,
           modelType: modelType,
-          chatId: chatId
+          // A conversation created for this very message is not in state yet
+          chatId: conversationId || chatId,
+          prefetchId: PREFETCH_ID
         }),
       });
 
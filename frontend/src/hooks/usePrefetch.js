@@ -0,0 +1,50 @@
+import { useEffect, useRef } from 'react';
+import { v4 as uuidv4 } from 'uuid';
+
+const PREFETCH_DEBOUNCE_MS = 400;
+const PREFETCH_MIN_CHARS = 12;
+
+// One prefetch session per page load; /api/chat sends the same ID so the server can reuse the results
+export const PREFETCH_ID = uuidv4();
+
+let prefetchSeq = 0;
+
+// Warm retrieval on the server for a draft once the user pauses typing
+export default function usePrefetch(draft, modelType) {
+  const controllerRef = useRef(null);
+
+  useEffect(() => {
+    const text = draft.trim();
+    if (text.length < PREFETCH_MIN_CHARS) return;
+
+    const timer = setTimeout(() => {
+      // A newer draft supersedes the request still in flight
+      controllerRef.current?.abort();
+      const controller = new AbortController();
+      controllerRef.current = controller;
+      prefetchSeq += 1;
+
+      fetch(`${process.env.NEXT_PUBLIC_BACKEND_URL}/api/prefetch`, {
+        method: 'POST',
+        headers: {
+          'Content-Type': 'application/json',
+        },
+        body: JSON.stringify({
+          prefetchId: PREFETCH_ID,
+          message: text,
+          modelType,
+          seq: prefetchSeq,
+        }),
+        signal: controller.signal,
+      }).catch(() => {
+        // Prefetching is best effort; the submitted request retrieves on its own
+      });
+    }, PREFETCH_DEBOUNCE_MS);
+
+    return () => clearTimeout(timer);
+  }, [draft, modelType]);
+
+  useEffect(() => {
+    return () => controllerRef.current?.abort();
+  }, []);
+}
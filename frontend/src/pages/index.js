@@ -58,9 +58,12 @@ export default function Home() {
   const handleChatSubmit = async (e, modelType) => {
     const userMessage = { role: 'user', content: input };
     
+    let conversationId = selectedConversationId;
+
     // If this is the first message and no conversation is selected, create one
     if (messages.length === 0) {
       const id = uuidv4();
+      conversationId = id;
       // Create a title from the first few words of the message
       const title = input.split(' ').slice(0, 4).join(' ') + (input.length > 20 ? '...' : '');
       
@@ -71,7 +74,7 @@ export default function Home() {
     }
     
     // Submit the message
-    await handleSubmit(e, modelType);
+    await handleSubmit(e, modelType, conversationId);
   };
 
   // Handle deleting a conversation